@@ -0,0 +1,77 @@
+"""
+  Benchmarks SpamFilter against checking each spam flag with re.match
+  Run from the root of Merely Framework with `python -m overlay.benchmarks.spam_filter`
+"""
+
+from __future__ import annotations
+
+import asyncio, random, re, string, time
+
+from overlay.extensions.confessions_common import SpamFilter
+
+PATTERNS = 1000
+CONFESSIONS = 200
+LENGTH = 3900
+
+
+def generate_flags(count:int) -> list[str]:
+  """ Spam flags in the style of the defaults, mostly anchored with a few unanchored ones """
+  flags = []
+  for i in range(count):
+    if i % 10 == 0:
+      flags.append(rf'.*spam{i}\.example\/.+')
+    else:
+      flags.append(rf'(?:https?:\/\/)?spam{i}\.example\/.+')
+  flags.append(r'^\s+$')
+  return flags
+
+
+def generate_confessions(count:int, length:int) -> list[str]:
+  """ Confessions of the maximum length which don't trip any flags """
+  rng = random.Random(0)
+  alphabet = string.ascii_letters + '     .,'
+  return [''.join(rng.choices(alphabet, k=length)) for _ in range(count)]
+
+
+def naive(flags:list[str], content:str) -> str | None:
+  """ The original implementation of check_spam """
+  for flag in flags:
+    if re.match(flag, content):
+      return flag
+  return None
+
+
+def measure(label:str, func, confessions:list[str]):
+  start = time.perf_counter()
+  for content in confessions:
+    func(content)
+  elapsed = time.perf_counter() - start
+  print(f" - {label}: {elapsed*1000:.1f}ms total, {elapsed/len(confessions)*1_000_000:.0f}µs per confession")
+
+
+async def measure_async(label:str, func, confessions:list[str]):
+  start = time.perf_counter()
+  for content in confessions:
+    await func(content)
+  elapsed = time.perf_counter() - start
+  print(f" - {label}: {elapsed*1000:.1f}ms total, {elapsed/len(confessions)*1_000_000:.0f}µs per confession")
+
+
+def main():
+  flags = generate_flags(PATTERNS)
+  confessions = generate_confessions(CONFESSIONS, LENGTH)
+  print(f"{len(flags)} spam flags against {CONFESSIONS} confessions of {LENGTH} characters")
+
+  spam_filter = SpamFilter(budget=1.0)
+  start = time.perf_counter()
+  spam_filter.load('\n'.join(flags))
+  print(f" - compile: {(time.perf_counter() - start)*1000:.1f}ms")
+
+  naive(flags, confessions[0]) # warm up the re module cache
+  measure("re.match per flag", lambda c: naive(flags, c), confessions)
+  measure("SpamFilter.match", spam_filter.match, confessions)
+  asyncio.run(measure_async("SpamFilter.check", spam_filter.check, confessions))
+
+
+if __name__ == '__main__':
+  main()
@@ -8,7 +8,7 @@
 
 from __future__ import annotations
 
-import time
+import asyncio, math
 from base64 import b64encode
 from typing import Optional, Union, TYPE_CHECKING
 import discord
@@ -21,8 +21,11 @@ if TYPE_CHECKING:
   from configparser import SectionProxy
 
 from overlay.extensions.confessions_common import (
-  ChannelType, ChannelSelectView, ConfessionData, NoMemberCacheError, Crypto, get_guildchannels,
-  safe_fetch_channel
+  ChannelType, ChannelSelectView, ConfessionData, ConfessionTarget, CooldownStore, FloodControl,
+  NoMemberCacheError, Crypto, SelectiveMembers, SendDispatcher, SharedSession, SpamFilter,
+  TargetSearch, UserGuildIndex, anonid_cache, findvettingchannel, get_guildchannels,
+  guildchannel_index, referenced_message_cache, resolution_stats, safe_fetch_channel,
+  visibility_cache
 )
 
 
@@ -58,8 +61,40 @@ class Confessions(commands.Cog):
         )
     if 'spam_flags' not in self.config:
       self.config['spam_flags'] = ''
+    if 'spam_budget' not in self.config:
+      self.config['spam_budget'] = '0.25'
     if 'dm_notifications' not in self.config:
       self.config['dm_notifications'] = ''
+    if 'http_limit' not in self.config:
+      self.config['http_limit'] = '100'
+    if 'http_limit_per_host' not in self.config:
+      self.config['http_limit_per_host'] = '10'
+    if 'http_keepalive' not in self.config:
+      self.config['http_keepalive'] = '60'
+    if 'http_timeout' not in self.config:
+      self.config['http_timeout'] = '30'
+    if 'selective_members' not in self.config:
+      self.config['selective_members'] = 'False'
+    if 'selective_members_ttl' not in self.config:
+      self.config['selective_members_ttl'] = '300'
+    if 'autocomplete_ttl' not in self.config:
+      self.config['autocomplete_ttl'] = '30'
+    if 'autocomplete_budget' not in self.config:
+      self.config['autocomplete_budget'] = '1.0'
+    if 'flood_guild' not in self.config:
+      self.config['flood_guild'] = '30/60'
+    if 'flood_channel' not in self.config:
+      self.config['flood_channel'] = '15/60'
+    if 'send_workers' not in self.config:
+      self.config['send_workers'] = '8'
+    if 'send_retries' not in self.config:
+      self.config['send_retries'] = '3'
+    if 'reference_cache_size' not in self.config:
+      self.config['reference_cache_size'] = '10000'
+    if 'reference_cache_ttl' not in self.config:
+      self.config['reference_cache_ttl'] = str(7 * 24 * 60 * 60)
+    if 'stats_interval' not in self.config:
+      self.config['stats_interval'] = '0'
 
     if not bot.config.getboolean('extensions', 'confessions_setup', fallback=False):
       if not bot.quiet:
@@ -69,7 +104,38 @@ class Confessions(commands.Cog):
         print(" - WARN: Without `confessions_moderation` enabled, vetting channels won't work")
 
     self.crypto.key = self.config['secret']
-    self.confession_cooldown = dict()
+    self.confession_cooldown = CooldownStore(100_000)
+    self.flood_control = FloodControl(100_000)
+    self.webhook_cache:dict[int, discord.Webhook] = {}
+    self.spam_filter = SpamFilter(budget=self.config.getfloat('spam_budget'))
+    self.spam_filter.load(self.config['spam_flags'])
+    self.userguild_index = UserGuildIndex()
+    self.target_search = TargetSearch(
+      size=10_000,
+      ttl=self.config.getfloat('autocomplete_ttl'),
+      budget=self.config.getfloat('autocomplete_budget')
+    )
+    self.selective_members = None
+    if self.config.getboolean('selective_members'):
+      if bot.intents.members and not bot.member_cache:
+        self.selective_members = SelectiveMembers(
+          size=100_000, ttl=self.config.getfloat('selective_members_ttl')
+        )
+      elif not bot.quiet:
+        print(" - WARN: selective_members needs the members intent with the member cache disabled")
+    referenced_message_cache.entries.size = self.config.getint('reference_cache_size')
+    referenced_message_cache.ttl = self.config.getfloat('reference_cache_ttl')
+    self.session = SharedSession(
+      limit=self.config.getint('http_limit'),
+      limit_per_host=self.config.getint('http_limit_per_host'),
+      keepalive=self.config.getfloat('http_keepalive'),
+      timeout=self.config.getfloat('http_timeout')
+    )
+
+    self.dispatcher = SendDispatcher(
+      workers=self.config.getint('send_workers'), retries=self.config.getint('send_retries')
+    )
+    self.stats_task:asyncio.Task | None = None
 
     self.confess_reply = app_commands.ContextMenu(
       name="Confession Reply",
@@ -79,14 +145,29 @@ class Confessions(commands.Cog):
     )
     bot.tree.add_command(self.confess_reply)
 
+  async def cog_load(self):
+    await self.session.start()
+    await self.dispatcher.start()
+    if self.bot.is_ready():
+      self.build_userguild_index()
+    if self.config.getfloat('stats_interval') > 0:
+      self.stats_task = asyncio.create_task(self.log_stats())
+
   async def cog_unload(self):
     self.bot.tree.remove_command(self.confess_reply.name, type=self.confess_reply.type)
+    if self.stats_task:
+      self.stats_task.cancel()
+    if self.selective_members:
+      self.selective_members.close()
+    await self.dispatcher.close()
+    await self.session.close()
 
   # Context menu commands
 
-  @commands.cooldown(1, 1, type=commands.BucketType.user)
   async def confess_reply_callback(self, inter:discord.Interaction, message:discord.Message):
     """ Start a confession in this channel replying to this message """
+    if await self.check_cooldown(inter):
+      return
     if message.is_system():
       await inter.response.send_message(self.babel(inter, 'confession_reply_failed'), ephemeral=True)
       return
@@ -96,10 +177,55 @@ class Confessions(commands.Cog):
 
   #	Utility functions
 
+  async def stats(self) -> dict[str, dict]:
+    """ Counters of every cache and queue, including those of the other confessions cogs """
+    stats = {
+      'session': self.session.stats(),
+      'dispatcher': self.dispatcher.stats(),
+      'spam_filter': self.spam_filter.stats(),
+      'anonid_cache': anonid_cache.stats(),
+      'resolution': resolution_stats.stats(),
+      'userguild_index': self.userguild_index.stats(),
+      'confession_cooldown': self.confession_cooldown.stats(),
+      'flood_control': self.flood_control.stats(),
+      'visibility_cache': visibility_cache.stats(),
+      'reference_cache': referenced_message_cache.stats(),
+      'target_search': self.target_search.stats()
+    }
+    if self.selective_members:
+      stats['selective_members'] = self.selective_members.stats(self.userguild_index)
+    for name in ('ConfessionsModeration', 'ConfessionsMarketplace'):
+      if cog := self.bot.get_cog(name):
+        stats.update(await cog.stats())
+    return stats
+
+  async def log_stats(self):
+    """ Print the stats every stats_interval seconds """
+    while True:
+      await asyncio.sleep(self.config.getfloat('stats_interval'))
+      try:
+        stats = await self.stats()
+      except Exception as e:
+        print(f" - WARN: Failed to collect confessions stats; {e!r}")
+        continue
+      for name, values in stats.items():
+        print(f" - STATS: {name} {values}")
+
+  async def check_cooldown(self, inter:discord.Interaction) -> bool:
+    """ Start the confession cooldown for this user, or tell them to wait if it's still going """
+    if remaining := self.confession_cooldown.check(
+      inter.user.id, self.config.getfloat('confession_cooldown', fallback=1)
+    ):
+      await inter.response.send_message(
+        self.babel(inter, 'confession_cooldown', time=math.ceil(remaining)), ephemeral=True
+      )
+      return True
+    return False
+
   def generate_list(
     self,
     user:discord.User,
-    matches:list[tuple[discord.TextChannel, ChannelType]],
+    matches:list[ConfessionTarget],
     vetting:bool
   ) -> str:
     """ Returns a formatted list of available confession targets """
@@ -107,8 +233,8 @@ class Confessions(commands.Cog):
     targets = []
     for match in matches:
       targets.append(
-        f'{match[1].icon} <#{match[0].id}>' +
-        (' ('+match[0].guild.name+')' if not isinstance(user, discord.Member) else '')
+        f'{match.channeltype.icon} <#{match.channel.id}>' +
+        (' ('+match.guildname+')' if not isinstance(user, discord.Member) else '')
       )
     vettingwarning = ('\n\n'+self.babel(user, 'vetting') if vetting else '')
 
@@ -116,34 +242,27 @@ class Confessions(commands.Cog):
 
   def scanguild(
     self, member:discord.Member
-  ) -> tuple[list[tuple[discord.TextChannel, ChannelType]], bool]:
+  ) -> tuple[list[ConfessionTarget], bool]:
     """ Scans a guild for any targets that a member can use for confessions """
 
-    matches:list[tuple[discord.TextChannel, ChannelType]] = []
-    vetting = False
-    guildchannels = get_guildchannels(self.config, member.guild.id)
-    for channel in member.guild.channels:
-      if channel.id in guildchannels:
-        if guildchannels[channel.id] == ChannelType.vetting:
-          vetting = True
-          continue
-        channel.name = channel.name[:40] + ('...' if len(channel.name) > 40 else '')
-        channel.guild.name = channel.guild.name[:40]+('...' if len(channel.guild.name) > 40 else '')
-        if 'feedback' in guildchannels[channel.id].name:
-          matches.append((channel, guildchannels[channel.id]))
-          continue
-        if channel.permissions_for(member).read_messages:
-          matches.append((channel, guildchannels[channel.id]))
-          continue
-
-    matches.sort(key=lambda t: (t[0].category.position if t[0].category else 0, t[0].position))
+    matches = [
+      target for target in guildchannel_index.get_targets(self.config, member.guild)
+      if 'feedback' in target.channeltype.name or visibility_cache.can_read(target.channel, member)
+    ]
+    vettingchannel = findvettingchannel(self.config, member.guild.id)
+    vetting = vettingchannel is not None and member.guild.get_channel(vettingchannel) is not None
 
     return matches, vetting
 
-  def listavailablechannels(
+  @property
+  def dm_available(self) -> bool:
+    """ DM confessions need either the member cache or selective members """
+    return bool(self.bot.member_cache or self.selective_members)
+
+  async def listavailablechannels(
       self,
       user:Union[discord.User, discord.Member]
-    ) -> tuple[list[tuple[discord.TextChannel, ChannelType]], bool]:
+    ) -> tuple[list[ConfessionTarget], bool]:
     """
       List all available targets on a server for a member
       List all available targets on all mutual servers for a user
@@ -156,14 +275,34 @@ class Confessions(commands.Cog):
         raise NoMemberCacheError()
       matches = []
       vetting = False
-      for guild in self.bot.guilds:
-        if member := guild.get_member(user.id):
+      for guild_id in tuple(self.userguild_index.get(user.id)):
+        guild = self.bot.get_guild(guild_id)
+        if guild is None:
+          continue
+        if self.selective_members:
+          member = await self.selective_members.get_member(guild, user.id)
+        else:
+          member = guild.get_member(user.id)
+        if member:
           newmatches, newvetting = self.scanguild(member)
           matches += newmatches
           vetting = vetting or newvetting
 
     return matches, vetting
 
+  def build_userguild_index(self):
+    """ Index the members of every guild that has confession channels """
+    self.userguild_index = UserGuildIndex()
+    guilds:list[discord.Guild] = []
+    for key in self.config:
+      guild_id, _, suffix = key.partition('_')
+      if suffix == 'channels' and guild_id.isdigit():
+        if guild := self.bot.get_guild(int(guild_id)):
+          self.userguild_index.add_guild(guild.id, (member.id for member in guild.members))
+          guilds.append(guild)
+    if self.selective_members:
+      self.selective_members.schedule(guilds, self.userguild_index)
+
   async def verify_and_send(
     self,
     inter:discord.Interaction,
@@ -172,7 +311,7 @@ class Confessions(commands.Cog):
     """ Ensure Confession is in a valid state to send and handle all contingencies """
     send = (inter.followup.send if inter.response.is_done() else inter.response.send_message)
 
-    matches,_ = self.listavailablechannels(inter.user)
+    matches,_ = await self.listavailablechannels(inter.user)
     if not matches:
       await send(self.babel(inter, 'inaccessiblelocal'), ephemeral=True)
       return
@@ -188,15 +327,19 @@ class Confessions(commands.Cog):
         )
         return
 
-      # Check for vetting
-      if vettingchannel := await data.check_vetting(inter):
-        await self.bot.cogs['ConfessionsModeration'].send_vetting(inter, data, vettingchannel)
-        return
-      if vettingchannel is False:
-        return
+      try:
+        # Check for vetting
+        if vettingchannel := await data.check_vetting(inter):
+          await self.bot.cogs['ConfessionsModeration'].send_vetting(inter, data, vettingchannel)
+          return
+        if vettingchannel is False:
+          return
 
-      # Let ConfessionData take it from here
-      await data.send_confession(inter, success_message=True)
+        # Let ConfessionData take it from here
+        await data.send_confession(inter, success_message=True)
+      finally:
+        # There is no way to retry from here, so free the image if sending failed
+        data.release_image()
 
     else:
       # User never input any message, give them a paragraph editor
@@ -247,21 +390,104 @@ class Confessions(commands.Cog):
     ):
       await inter.response.send_message(self.babel(inter, 'no_moderation'))
 
+  @commands.Cog.listener('on_webhooks_update')
+  async def webhook_invalidate(self, channel:discord.abc.GuildChannel):
+    """ Forget cached webhooks when the webhooks in a channel change """
+    self.webhook_cache.pop(channel.id, None)
+
+  @commands.Cog.listener('on_guild_channel_delete')
+  async def channel_invalidate(self, channel:discord.abc.GuildChannel):
+    """ Forget anything cached about a deleted channel """
+    self.webhook_cache.pop(channel.id, None)
+    guildchannel_index.invalidate_targets(channel.guild.id)
+    visibility_cache.invalidate_channel(channel.id)
+
+  @commands.Cog.listener('on_guild_channel_create')
+  async def channel_create_invalidate(self, channel:discord.abc.GuildChannel):
+    """ New channels and categories can shift the position of confession targets """
+    guildchannel_index.invalidate_targets(channel.guild.id)
+
+  @commands.Cog.listener('on_guild_channel_update')
+  async def channel_update_invalidate(
+    self, before:discord.abc.GuildChannel, after:discord.abc.GuildChannel
+  ):
+    """ Rebuild confession targets when a channel is renamed or moved, recheck visibility """
+    if (
+      before.name != after.name or before.position != after.position or
+      getattr(before, 'category_id', None) != getattr(after, 'category_id', None)
+    ):
+      guildchannel_index.invalidate_targets(after.guild.id)
+    if isinstance(after, discord.CategoryChannel):
+      for channel in after.channels:
+        visibility_cache.invalidate_channel(channel.id)
+    visibility_cache.invalidate_channel(after.id)
+
+  @commands.Cog.listener('on_guild_role_create')
+  @commands.Cog.listener('on_guild_role_delete')
+  async def role_invalidate(self, role:discord.Role):
+    """ Channel visibility is cached per role combination """
+    visibility_cache.invalidate_guild(role.guild.id)
+
+  @commands.Cog.listener('on_guild_role_update')
+  async def role_update_invalidate(self, before:discord.Role, after:discord.Role):
+    """ Changes to role permissions can change which channels members can read """
+    if before.permissions != after.permissions:
+      visibility_cache.invalidate_guild(after.guild.id)
+
+  @commands.Cog.listener('on_guild_update')
+  async def guild_update_invalidate(self, before:discord.Guild, after:discord.Guild):
+    """ Guild names are shown alongside confession targets """
+    if before.name != after.name:
+      guildchannel_index.invalidate_targets(after.id)
+
+  @commands.Cog.listener('on_ready')
+  async def userguild_build(self):
+    """ Build the user to guild index once the member cache is available """
+    self.build_userguild_index()
+
+  @commands.Cog.listener('on_member_join')
+  async def userguild_join(self, member:discord.Member):
+    """ Track new members of configured guilds """
+    self.userguild_index.add_member(member.guild.id, member.id)
+
+  @commands.Cog.listener('on_member_remove')
+  async def userguild_leave(self, member:discord.Member):
+    """ Stop offering a guild to members who left it """
+    self.userguild_index.remove_member(member.guild.id, member.id)
+
+  @commands.Cog.listener('on_guild_remove')
+  async def userguild_guild_remove(self, guild:discord.Guild):
+    """ Forget the members of a guild the bot is no longer in """
+    self.userguild_index.remove_guild(guild.id)
+    if self.selective_members:
+      self.selective_members.forget(guild.id)
+
+  @commands.Cog.listener('on_confessions_channels_update')
+  async def userguild_channels_update(self, guild:discord.Guild):
+    """ Index or drop a guild when it gains its first or loses its last confession channel """
+    if get_guildchannels(self.config, guild.id):
+      if guild.id not in self.userguild_index.members:
+        self.userguild_index.add_guild(guild.id, (member.id for member in guild.members))
+        if self.selective_members:
+          self.selective_members.schedule((guild,), self.userguild_index)
+    else:
+      self.userguild_index.remove_guild(guild.id)
+      if self.selective_members:
+        self.selective_members.forget(guild.id)
+
   @commands.Cog.listener('on_message')
   async def confession_request(self, msg:discord.Message):
     """ Handle plain DM messages as confessions """
     if isinstance(msg.channel, discord.DMChannel) and msg.author != self.bot.user:
-      if msg.author in self.confession_cooldown and\
-         self.confession_cooldown[msg.author] > time.time():
+      if self.confession_cooldown.check(
+        msg.author.id, self.config.getfloat('confession_cooldown', fallback=1)
+      ):
         return
-      else:
-        self.confession_cooldown[msg.author] = time.time() +\
-          int(self.config.get('confession_cooldown', fallback=1))
 
-      if not self.bot.member_cache:
+      if not self.dm_available:
         await msg.reply(self.babel(msg, 'dmconfessiondisabled'))
         return
-      matches,_ = self.listavailablechannels(msg.author)
+      matches,_ = await self.listavailablechannels(msg.author)
 
       if not self.bot.is_ready():
         await msg.reply(self.babel(msg, 'cachebuilding'))
@@ -286,7 +512,6 @@ class Confessions(commands.Cog):
     content="The text of your anonymous message, leave blank for a paragraph editor",
     image="An optional image that appears below the text"
   )
-  @commands.cooldown(1, 1, type=commands.BucketType.user)
   async def confess(
     self,
     inter:discord.Interaction,
@@ -296,6 +521,8 @@ class Confessions(commands.Cog):
     """
       Send an anonymous message to this channel
     """
+    if await self.check_cooldown(inter):
+      return
     pendingconfession = ConfessionData(self)
     pendingconfession.create(author=inter.user, targetchannel=inter.channel)
     pendingconfession.set_content(content)
@@ -311,7 +538,6 @@ class Confessions(commands.Cog):
     content="The text of your anonymous message, leave blank for a paragraph editor",
     image="An optional image that appears below the text"
   )
-  @commands.cooldown(1, 1, type=commands.BucketType.user)
   async def confess_to(
     self,
     inter:discord.Interaction,
@@ -322,6 +548,8 @@ class Confessions(commands.Cog):
     """
       Send an anonymous message to a specified channel
     """
+    if await self.check_cooldown(inter):
+      return
     if channel.isdigit() and int(channel):
       if targetchannel := await safe_fetch_channel(self, inter, int(channel)):
         pendingconfession = ConfessionData(self)
@@ -343,13 +571,15 @@ class Confessions(commands.Cog):
         value='-1'
       )]
 
-    results = []
-    matches, _ = self.scanguild(inter.user)
-    for match in matches:
-      if search in match[0].name:
-        results.append(
-          app_commands.Choice(name=f"{match[1].icon} #{match[0].name}", value=str(match[0].id))
-        )
+    matches = self.target_search.get(inter.guild.id, inter.user.id)
+    if matches is None:
+      matches, _ = self.scanguild(inter.user)
+      self.target_search.put(inter.guild.id, inter.user.id, matches)
+    results = [
+      app_commands.Choice(
+        name=f"{match.channeltype.icon} #{match.name}", value=str(match.channel.id)
+      ) for match in self.target_search.search(matches, search)
+    ]
     return results[0:24] + (
       [app_commands.Choice(name='this list is incomplete, use /list to see all', value='0')]
       if len(results) > 25 else []
@@ -360,31 +590,36 @@ class Confessions(commands.Cog):
     """
     List all anonymous channels available here
     """
+    local = isinstance(inter.user, discord.Member)
+    if self.selective_members and not local:
+      # Members may need to be fetched first
+      await inter.response.defer(ephemeral=True)
+    send = (inter.followup.send if inter.response.is_done() else inter.response.send_message)
+
     try:
-      matches, vetting = self.listavailablechannels(inter.user)
+      matches, vetting = await self.listavailablechannels(inter.user)
     except NoMemberCacheError:
-      await inter.response.send_message(self.babel(inter, 'dmconfessiondisabled'))
+      await send(self.babel(inter, 'dmconfessiondisabled'))
       return
 
     # Warn users when the channel list isn't complete
-    local = isinstance(inter.user, discord.Member)
     if not self.bot.is_ready() and not local:
-      await inter.response.send_message(self.babel(inter, 'cachebuilding'), ephemeral=True)
+      await send(self.babel(inter, 'cachebuilding'), ephemeral=True)
     elif len(matches) == 0:
-      await inter.response.send_message(
+      await send(
         self.babel(inter, 'inaccessiblelocal' if local else 'inaccessible'),
         ephemeral=True
       )
     # Send the list of channels, complete or not
     if len(matches) > 0:
       #BABEL: listtitlelocal,listtitle
-      await inter.response.send_message((
+      await send((
         self.babel(inter, 'listtitlelocal' if local else 'listtitle') + '\n' +
         self.generate_list(inter.user, matches, vetting) +
         (
           # Hint on how to confess to a feedback channel
           '\n\n' + self.babel(inter, 'confess_to_feedback')
-          if [m for m in matches if 'feedback' in m[1].name] else ''
+          if [m for m in matches if 'feedback' in m.channeltype.name] else ''
         )
       ), ephemeral=True)
 
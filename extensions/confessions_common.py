@@ -5,18 +5,19 @@
 """
 from __future__ import annotations
 
-import io, re, secrets
+import asyncio, heapq, io, math, re, secrets, tempfile, time
 from base64 import b64encode, b64decode
 from Crypto.Cipher import AES
 from Crypto.Hash import SHA
-from typing import Optional, Union, TYPE_CHECKING
-from collections import OrderedDict
+from typing import NamedTuple, Optional, Union, TYPE_CHECKING
+from collections import OrderedDict, deque
 import discord
 from discord.ext import commands
 import aiohttp
+import regex
 
 if TYPE_CHECKING:
-  from collections.abc import Mapping
+  from collections.abc import Awaitable, Callable, Iterable, Mapping
   from overlay.extensions.confessions import Confessions
   from overlay.extensions.confessions_moderation import ConfessionsModeration
   from overlay.extensions.confessions_setup import ConfessionsSetup
@@ -26,6 +27,35 @@ if TYPE_CHECKING:
 
 # Data Classes
 
+class BoundedLRU(OrderedDict):
+  """
+    An OrderedDict which evicts its least recently used items once it holds more than size
+
+    get and put mark an item as recently used, peek and plain indexing don't.
+  """
+  def __init__(self, size:int):
+    super().__init__()
+    self.size = size
+
+  def get(self, key, default=None):
+    """ Returns an item and marks it as recently used """
+    if key not in self:
+      return default
+    self.move_to_end(key)
+    return self[key]
+
+  def peek(self, key, default=None):
+    """ Returns an item without changing the order """
+    return super().get(key, default)
+
+  def put(self, key, value):
+    """ Stores an item as recently used, evicting the least recently used items if full """
+    self[key] = value
+    self.move_to_end(key)
+    while len(self) > self.size:
+      self.popitem(last=False)
+
+
 class ChannelType:
   """ Anonymous channel types and their properties """
   name:str
@@ -53,6 +83,9 @@ class ChannelType:
   VETTED = None
   DEPS = None
 
+  _babel_keys:dict[int, str] = {}
+  _babel_source = None
+
   def __init__(
     self,
     *,
@@ -100,18 +133,34 @@ class ChannelType:
   def __eq__(self, other):
     return isinstance(other, ChannelType) and other.value == self.value
 
+  @classmethod
+  def babel_keys(cls, babel:Babel) -> dict[int, str]:
+    """
+      Map each channeltype value to the babel key that names it
+
+      Built once per loaded language file, range keys are expanded up front
+    """
+    source = babel.langs[babel.defaultlang]
+    if cls._babel_source is not source:
+      keys:dict[int, str] = {}
+      #BABEL: channeltype_#,channeltype_#-#
+      for key in source['confessions']:
+        if not key.startswith('channeltype_'):
+          continue
+        suffix = key[12:]
+        if suffix.lstrip('-').isdigit():
+          keys.setdefault(int(suffix), key)
+        elif len(key) == 15:
+          for value in range(int(key[-3]), int(key[-1]) + 1):
+            keys.setdefault(value, key)
+      cls._babel_keys = keys
+      cls._babel_source = source
+    return cls._babel_keys
+
   def localname(self, babel:Babel, target:Resolvable, long:bool = True) -> str:
     """ Find name of the current ChannelType in Babel """
-    name = None
-    #BABEL: channeltype_#,channeltype_#-#
-    for key in babel.langs[babel.defaultlang]['confessions']:
-      if key.startswith('channeltype_'):
-        if key == f'channeltype_{self.value}':
-          name = babel(target, 'confessions', key)
-          break
-        elif len(key) == 15 and self.value in range(int(key[-3]), int(key[-1]) + 1):
-          name = babel(target, 'confessions', key)
-          break
+    key = self.babel_keys(babel).get(self.value)
+    name = babel(target, 'confessions', key) if key else None
     ext = None
     if long and self.swap:
       if self.anonid:
@@ -163,27 +212,412 @@ def get_channeltypes(cogs:Mapping[str, commands.Cog]) -> list[ChannelType]:
   return [c for c in ChannelType.walk() if c.dep is None or c.dep in cogs]
 
 
-def findvettingchannel(guildchannels:dict[int, ChannelType]) -> Optional[int]:
+class ConfessionTarget(NamedTuple):
+  """ A channel that can be confessed to, with names truncated for display """
+  channel:discord.TextChannel
+  channeltype:ChannelType
+  name:str
+  guildname:str
+  searchname:str
+  searchcategory:str
+
+  @classmethod
+  def create(cls, channel:discord.TextChannel, channeltype:ChannelType) -> ConfessionTarget:
+    """ Create a target without modifying the names of the cached channel and guild """
+    return cls(
+      channel,
+      channeltype,
+      channel.name[:40] + ('...' if len(channel.name) > 40 else ''),
+      channel.guild.name[:40] + ('...' if len(channel.guild.name) > 40 else ''),
+      channel.name.casefold(),
+      channel.category.name.casefold() if channel.category else ''
+    )
+
+
+def target_sort_key(target:ConfessionTarget) -> tuple[int, int]:
+  """ Sort targets the same way as the Discord channel list """
+  channel = target.channel
+  return (channel.category.position if channel.category else 0, channel.position)
+
+
+class TargetSearch:
+  """
+    Ranked channel search for autocomplete
+
+    The targets a member can see are cached for a short time, so each keystroke only has to rank a
+    short list. Ranking stops early when it runs out of time, returning the best results so far.
+  """
+  WORD_SPLIT = re.compile(r'[-_\s]+')
+
+  def __init__(self, size:int, ttl:float, budget:float):
+    self.ttl = ttl
+    self.budget = budget
+    self.entries:BoundedLRU[tuple[int, int], tuple[list[ConfessionTarget], float]] = BoundedLRU(size)
+    self.hits = 0
+    self.misses = 0
+    self.truncated = 0
+
+  def get(self, guild_id:int, member_id:int) -> list[ConfessionTarget] | None:
+    """ Returns the targets a member could see recently, if still fresh """
+    entry = self.entries.get((guild_id, member_id))
+    if entry is None or entry[1] < time.monotonic():
+      self.misses += 1
+      return None
+    self.hits += 1
+    return entry[0]
+
+  def put(self, guild_id:int, member_id:int, targets:list[ConfessionTarget]):
+    """ Remember the targets a member can see """
+    self.entries.put((guild_id, member_id), (targets, time.monotonic() + self.ttl))
+
+  @classmethod
+  def score(cls, target:ConfessionTarget, query:str) -> tuple[int, int] | None:
+    """ Rank a target for a casefolded query, lower is better, None is no match """
+    name = target.searchname
+    if name == query:
+      return (0, 0)
+    if name.startswith(query):
+      return (1, len(name))
+    if any(word.startswith(query) for word in cls.WORD_SPLIT.split(name)):
+      return (2, len(name))
+    if query in name:
+      return (3, name.index(query))
+    if target.searchcategory.startswith(query):
+      return (4, 0)
+    if query in target.searchcategory:
+      return (5, 0)
+    # Fuzzy match, every character of the query appears in order
+    gaps = 0
+    position = 0
+    for char in query:
+      found = name.find(char, position)
+      if found < 0:
+        return None
+      gaps += found - position
+      position = found + 1
+    return (6, gaps)
+
+  def search(self, targets:list[ConfessionTarget], query:str) -> list[ConfessionTarget]:
+    """ Returns matching targets from best to worst, stopping early if over budget """
+    query = query.strip().lstrip('#').casefold()
+    if not query:
+      return targets
+    deadline = time.perf_counter() + self.budget
+    ranked = []
+    for i, target in enumerate(targets):
+      if i % 64 == 63 and time.perf_counter() > deadline:
+        self.truncated += 1
+        break
+      if (score := self.score(target, query)) is not None:
+        ranked.append((score, i, target))
+    ranked.sort(key=lambda r: r[:2])
+    return [target for _, _, target in ranked]
+
+  def stats(self) -> dict[str, int]:
+    """ Hit, miss and truncation counters """
+    return {
+      'hits': self.hits, 'misses': self.misses, 'truncated': self.truncated,
+      'size': len(self.entries)
+    }
+
+
+class GuildChannelIndex:
+  """
+    Parsed copy of every {guild_id}_channels config string
+
+    Guilds are parsed on first use, after that, set_guildchannels and update_guildchannels keep
+    the index and config in sync.
+    Sorted confession targets are built from the index on demand and dropped whenever the
+    configuration or the channels in a guild change.
+  """
+  def __init__(self):
+    self.channels:dict[int, dict[int, ChannelType]] = {}
+    self.vetting:dict[int, int | None] = {}
+    self.targets:dict[int, list[ConfessionTarget]] = {}
+
+  def get(self, config:SectionProxy, guild_id:int) -> dict[int, ChannelType]:
+    """ Returns the parsed channels for a guild, parsing config only if it hasn't been seen yet """
+    if guild_id not in self.channels:
+      self.load(guild_id, {int(k):ChannelType.from_value(v) for k,v in (
+        e.split('=') for e in config.get(f'{guild_id}_channels', fallback='').split(',') if e
+      )})
+    return self.channels[guild_id]
+
+  def get_targets(self, config:SectionProxy, guild:discord.Guild) -> list[ConfessionTarget]:
+    """ Returns every configured channel in a guild except vetting, in channel list order """
+    if guild.id not in self.targets:
+      targets = []
+      for channel_id, channeltype in self.get(config, guild.id).items():
+        if channeltype == ChannelType.vetting:
+          continue
+        if channel := guild.get_channel(channel_id):
+          targets.append(ConfessionTarget.create(channel, channeltype))
+      targets.sort(key=target_sort_key)
+      self.targets[guild.id] = targets
+    return self.targets[guild.id]
+
+  def invalidate_targets(self, guild_id:int):
+    """ Rebuild targets the next time they're needed, for when channels or names change """
+    self.targets.pop(guild_id, None)
+
+  def load(self, guild_id:int, guildchannels:dict[int, ChannelType]):
+    """ Replaces the index for a guild """
+    self.channels[guild_id] = guildchannels
+    self.targets.pop(guild_id, None)
+    self.vetting[guild_id] = None
+    for channel_id, channeltype in guildchannels.items():
+      if channeltype == ChannelType.vetting:
+        self.vetting[guild_id] = channel_id
+
+  def update(self, guild_id:int, channel_id:int, channeltype:ChannelType):
+    """ Changes a single channel in the index, unset removes the channel """
+    guildchannels = self.channels[guild_id]
+    self.targets.pop(guild_id, None)
+    old = guildchannels.pop(channel_id, ChannelType.unset)
+    if channeltype != ChannelType.unset:
+      guildchannels[channel_id] = channeltype
+    if channeltype == ChannelType.vetting:
+      self.vetting[guild_id] = channel_id
+    elif old == ChannelType.vetting:
+      self.vetting[guild_id] = None
+
+  def forget(self, guild_id:int):
+    """ Drops a guild from the index, it will be parsed from config again if needed """
+    self.channels.pop(guild_id, None)
+    self.vetting.pop(guild_id, None)
+    self.targets.pop(guild_id, None)
+
+
+guildchannel_index = GuildChannelIndex()
+
+
+def findvettingchannel(config:SectionProxy, guild_id:int) -> Optional[int]:
   """ Check if guild has a vetting channel and return it """
-  for channel_id in guildchannels:
-    if guildchannels[channel_id] == ChannelType.vetting:
-      return channel_id
-  return None
+  guildchannel_index.get(config, guild_id)
+  return guildchannel_index.vetting[guild_id]
 
 
 def get_guildchannels(config:SectionProxy, guild_id:int) -> dict[int, ChannelType]:
-  """ Returns a dictionary of {channel_id: channel_type} for the provided guild """
-  return {int(k):ChannelType.from_value(v) for k,v in (
-    e.split('=') for e in config.get(f'{guild_id}_channels', fallback='').split(',') if e
-  )}
+  """
+    Returns a dictionary of {channel_id: channel_type} for the provided guild
+    This dictionary is shared, use update_guildchannels to make changes
+  """
+  return guildchannel_index.get(config, guild_id)
 
 
 def set_guildchannels(config:SectionProxy, guild_id:int, guildchannels:dict[int, ChannelType] | None):
   """ Writes a dictionary of {channel_id: channel_type} to the config """
+  guildchannel_index.load(guild_id, dict(guildchannels) if guildchannels else {})
+  write_guildchannels(config, guild_id)
+
+
+def update_guildchannels(config:SectionProxy, guild_id:int, changes:dict[int, ChannelType]):
+  """ Applies {channel_id: channel_type} changes in place, unset removes a channel """
+  guildchannel_index.get(config, guild_id)
+  for channel_id, channeltype in changes.items():
+    guildchannel_index.update(guild_id, channel_id, channeltype)
+  write_guildchannels(config, guild_id)
+
+
+def write_guildchannels(config:SectionProxy, guild_id:int):
+  """ Stores the indexed channels for a guild in the config """
+  guildchannels = guildchannel_index.channels[guild_id]
   if guildchannels:
     config[f'{guild_id}_channels'] = ','.join(f'{k}={int(v)}' for k,v in guildchannels.items())
   else:
-    config.pop(f'{guild_id}_channels')
+    config.pop(f'{guild_id}_channels', None)
+
+
+class BanIndex:
+  """
+    Parsed copy of every {guild_id}_banned config string, as a set of anon-ids per guild
+    Changes are made in memory and written back to config in one go
+  """
+  def __init__(self):
+    self.bans:dict[int, set[str]] = {}
+
+  def get(self, config:SectionProxy, guild_id:int) -> set[str]:
+    """ Returns the banned anon-ids for a guild, this set is shared so don't modify it """
+    if guild_id not in self.bans:
+      self.bans[guild_id] = {
+        i for i in config.get(f'{guild_id}_banned', fallback='').split(',') if i
+      }
+    return self.bans[guild_id]
+
+  def update(
+    self,
+    config:SectionProxy,
+    guild_id:int,
+    *,
+    add:Iterable[str] = (),
+    remove:Iterable[str] = ()
+  ):
+    """ Bans and unbans any number of anon-ids with a single config write """
+    banned = self.get(config, guild_id)
+    banned.update(add)
+    banned.difference_update(remove)
+    if banned:
+      config[f'{guild_id}_banned'] = ','.join(sorted(banned))
+    else:
+      config.pop(f'{guild_id}_banned', None)
+
+  def forget(self, guild_id:int):
+    """ Drops a guild from the index, it will be parsed from config again if needed """
+    self.bans.pop(guild_id, None)
+
+
+ban_index = BanIndex()
+
+
+class UserGuildIndex:
+  """
+    Members of every guild that has confession channels, indexed by user id
+
+    Lets DM confessions find a user's guilds without checking every guild the bot is in.
+  """
+  def __init__(self):
+    self.users:dict[int, set[int]] = {}
+    self.members:dict[int, set[int]] = {}
+
+  def get(self, user_id:int) -> set[int]:
+    """ Returns the ids of configured guilds this user is a member of, don't modify it """
+    return self.users.get(user_id, set())
+
+  def add_guild(self, guild_id:int, user_ids:Iterable[int]):
+    """ Index the members of a guild, replacing what was known about it """
+    self.remove_guild(guild_id)
+    self.members[guild_id] = set()
+    for user_id in user_ids:
+      self.add_member(guild_id, user_id)
+
+  def remove_guild(self, guild_id:int):
+    """ Forget all members of a guild """
+    for user_id in self.members.pop(guild_id, ()):
+      self._discard(user_id, guild_id)
+
+  def add_member(self, guild_id:int, user_id:int):
+    """ Add a member to an indexed guild, members of other guilds are ignored """
+    if guild_id in self.members:
+      self.members[guild_id].add(user_id)
+      self.users.setdefault(user_id, set()).add(guild_id)
+
+  def remove_member(self, guild_id:int, user_id:int):
+    """ Remove a member from an indexed guild """
+    if guild_id in self.members:
+      self.members[guild_id].discard(user_id)
+      self._discard(user_id, guild_id)
+
+  def _discard(self, user_id:int, guild_id:int):
+    guilds = self.users.get(user_id)
+    if guilds is not None:
+      guilds.discard(guild_id)
+      if not guilds:
+        del self.users[user_id]
+
+  def stats(self) -> dict[str, int]:
+    """ Size of the index """
+    return {'guilds': len(self.members), 'users': len(self.users)}
+
+
+class SelectiveMembers:
+  """
+    Member data for configured guilds only, for bots that don't keep a member cache
+
+    Configured guilds are chunked without caching one at a time in the background, only the ids are
+    kept in a UserGuildIndex. Member objects are then fetched when needed and kept for a short time.
+  """
+  def __init__(self, size:int, ttl:float):
+    self.ttl = ttl
+    self.members:BoundedLRU[tuple[int, int], tuple[discord.Member, float]] = BoundedLRU(size)
+    self.chunked:set[int] = set()
+    self.queue:deque[discord.Guild] = deque()
+    self.queued:set[int] = set()
+    self.task:asyncio.Task | None = None
+    self.index:UserGuildIndex | None = None
+    self.hits = 0
+    self.misses = 0
+
+  def schedule(self, guilds:Iterable[discord.Guild], index:UserGuildIndex):
+    """
+      Chunk these guilds in the background, guilds are indexed again even if already chunked
+
+      Chunked guilds are always added to the index from the latest call, so guilds that were
+      queued before the index was rebuilt still end up in the new one
+    """
+    self.index = index
+    for guild in guilds:
+      self.chunked.discard(guild.id)
+      if guild.id not in self.queued:
+        self.queued.add(guild.id)
+        self.queue.append(guild)
+    if self.queue and (self.task is None or self.task.done()):
+      self.task = asyncio.create_task(self.run())
+
+  async def run(self):
+    """ Index the members of queued guilds, one guild at a time """
+    while self.queue:
+      guild = self.queue.popleft()
+      if guild.id not in self.queued:
+        continue
+      try:
+        members = await guild.chunk(cache=False)
+      except (discord.HTTPException, asyncio.TimeoutError) as e:
+        print(f" - WARN: Failed to chunk guild {guild.id} for selective_members; {e}")
+        self.queued.discard(guild.id)
+        continue
+      if guild.id not in self.queued:
+        # Forgotten while chunking
+        continue
+      self.queued.discard(guild.id)
+      self.index.add_guild(guild.id, (member.id for member in members))
+      self.chunked.add(guild.id)
+
+  def forget(self, guild_id:int):
+    """ Stop indexing a guild, for when it is removed or no longer configured """
+    self.chunked.discard(guild_id)
+    self.queued.discard(guild_id)
+
+  def close(self):
+    """ Stop chunking """
+    if self.task:
+      self.task.cancel()
+    self.queue.clear()
+    self.queued.clear()
+
+  async def get_member(self, guild:discord.Guild, user_id:int) -> discord.Member | None:
+    """ Returns a member from the member cache, this cache, or the gateway """
+    if member := guild.get_member(user_id):
+      return member
+    now = time.time()
+    # Entries share a ttl and are read with peek, so the oldest entries are always first to expire
+    while self.members and next(iter(self.members.values()))[1] < now:
+      self.members.popitem(last=False)
+    if cached := self.members.peek((guild.id, user_id)):
+      self.hits += 1
+      return cached[0]
+    self.misses += 1
+    members = await guild.query_members(user_ids=[user_id], cache=False)
+    if not members:
+      return None
+    self.members.put((guild.id, user_id), (members[0], now + self.ttl))
+    return members[0]
+
+  def stats(self, index:UserGuildIndex) -> dict[int, dict[str, int]]:
+    """ Indexed member ids and cached member objects for each chunked guild """
+    cached:dict[int, int] = {}
+    for guild_id, _ in self.members:
+      cached[guild_id] = cached.get(guild_id, 0) + 1
+    return {
+      guild_id: {'indexed': len(index.members.get(guild_id, ())), 'cached': cached.get(guild_id, 0)}
+      for guild_id in self.chunked
+    }
+
+
+def forget_guild(guild_id:int):
+  """ Drops everything that has been cached about a guild, use after its config is removed """
+  guildchannel_index.forget(guild_id)
+  ban_index.forget(guild_id)
+  anonid_cache.invalidate(guild_id)
 
 
 async def safe_fetch_channel(
@@ -224,16 +658,19 @@ class ChannelSelectView(discord.ui.View):
       self,
       origin:discord.Message | discord.Interaction,
       parent:Confessions | ConfessionsSetup,
-      matches:list[tuple[discord.TextChannel, ChannelType]],
+      matches:list[ConfessionTarget],
       confession:ConfessionData | None = None
     ):
     super().__init__()
     self.origin = origin
     self.parent = parent
     self.matches = matches
-    self.selection = matches[0][0]
+    self.selection = matches[0].channel
     self.confession = confession
-    self.soleguild = matches[0][0].guild if all((m.guild for m,_ in matches)) else None
+    self.soleguild = (
+      matches[0].channel.guild
+      if all(m.channel.guild == matches[0].channel.guild for m in matches) else None
+    )
     self.update_list()
     self.channel_selector.placeholder = self.parent.babel(origin, 'channelprompt_placeholder')
     self.send_button.label = self.parent.babel(origin, 'channelprompt_button_send')
@@ -264,11 +701,11 @@ class ChannelSelectView(discord.ui.View):
     start = self.page*25
     self.channel_selector.options = [
       discord.SelectOption(
-        label='#' + channel.name + ('' if self.soleguild else f' (from {channel.guild.name})'),
-        value=channel.id,
-        emoji=channeltype.icon,
-        default=channel.id == self.selection.id if self.selection else False
-      ) for channel,channeltype in self.matches[start:start+25]
+        label='#' + target.name + ('' if self.soleguild else f' (from {target.guildname})'),
+        value=target.channel.id,
+        emoji=target.channeltype.icon,
+        default=target.channel.id == self.selection.id if self.selection else False
+      ) for target in self.matches[start:start+25]
     ]
 
   @discord.ui.select(custom_id='channelselect_selector')
@@ -282,7 +719,7 @@ class ChannelSelectView(discord.ui.View):
     self.selection = self.parent.bot.get_channel(int(this.values[0]))
     self.update_list()
     guildchannels = get_guildchannels(self.parent.config, self.selection.guild.id)
-    vetting = findvettingchannel(guildchannels)
+    vetting = findvettingchannel(self.parent.config, self.selection.guild.id)
     channeltype = guildchannels[self.selection.id]
     await inter.response.edit_message(
       content=self.parent.babel(
@@ -378,6 +815,9 @@ class ChannelSelectView(discord.ui.View):
       await inter.response.edit_message(view=self)
 
   async def on_timeout(self):
+    if self.confession:
+      # Nobody can retry sending this anymore
+      self.confession.release_image()
     originuser = (self.origin.author if isinstance(self.origin,discord.Message) else self.origin.user)
     try:
       if isinstance(self.origin, discord.Interaction):
@@ -407,6 +847,351 @@ class ChannelSelectView(discord.ui.View):
 
 # Data classes
 
+class SharedSession:
+  """
+    Long-lived, connection-pooled aiohttp session, owned by the Confessions cog
+
+    Reusing connections to Discord's CDN saves a TCP and TLS handshake on every image download.
+  """
+  session:aiohttp.ClientSession | None = None
+
+  def __init__(self, *, limit:int, limit_per_host:int, keepalive:float, timeout:float):
+    """
+      Parameters
+      ----------
+      limit: Maximum number of open connections
+      limit_per_host: Maximum number of open connections to a single host
+      keepalive: Seconds an idle connection is kept open for reuse
+      timeout: Seconds before a request is abandoned
+    """
+    self.limit = limit
+    self.limit_per_host = limit_per_host
+    self.keepalive = keepalive
+    self.timeout = timeout
+    self.pool_hits = 0
+    self.new_connections = 0
+
+  async def start(self):
+    """ Creates the session, must be called from within the event loop """
+    if self.session and not self.session.closed:
+      return
+    trace = aiohttp.TraceConfig()
+    trace.on_connection_reuseconn.append(self._on_reuse)
+    trace.on_connection_create_end.append(self._on_create)
+    self.session = aiohttp.ClientSession(
+      connector=aiohttp.TCPConnector(
+        limit=self.limit, limit_per_host=self.limit_per_host, keepalive_timeout=self.keepalive
+      ),
+      timeout=aiohttp.ClientTimeout(total=self.timeout),
+      trace_configs=[trace]
+    )
+
+  async def close(self):
+    """ Closes the session and all pooled connections """
+    if self.session:
+      await self.session.close()
+      self.session = None
+
+  def get(self, url:str, **kwargs):
+    """ Shorthand for self.session.get(url, **kwargs) """
+    if self.session is None or self.session.closed:
+      raise Exception("SharedSession was used before it was started or after it was closed")
+    return self.session.get(url, **kwargs)
+
+  async def _on_reuse(self, *_):
+    self.pool_hits += 1
+
+  async def _on_create(self, *_):
+    self.new_connections += 1
+
+  def stats(self) -> dict[str, int]:
+    """ Connection pool counters """
+    return {'pool_hits': self.pool_hits, 'new_connections': self.new_connections}
+
+
+class RateLimitBackoff:
+  """
+    Retries requests that Discord answers with 429 Too Many Requests
+
+    These are rate limits that made it past discord.py's own handling. Each retry waits for
+    Retry-After or an exponential backoff, whichever is longer. A global rate limit pauses every
+    request that goes through the same RateLimitBackoff.
+  """
+  def __init__(self, retries:int):
+    """
+      Parameters
+      ----------
+      retries: Number of times a rate limited request is retried before giving up
+    """
+    self.retries = retries
+    self.paused_until = 0.0
+    self.retried = 0
+
+  async def run(self, factory:Callable[[], Awaitable]):
+    """
+      Run factory(), retrying it if it's rate limited
+
+      factory is called again for each retry, so it must create a new coroutine every time
+    """
+    for attempt in range(self.retries + 1):
+      if (pause := self.paused_until - time.monotonic()) > 0:
+        await asyncio.sleep(pause)
+      try:
+        return await factory()
+      except discord.HTTPException as e:
+        if e.status != 429 or attempt == self.retries:
+          raise
+        headers = e.response.headers if e.response is not None else {}
+        delay = max(float(headers.get('Retry-After', 0)), 2 ** attempt)
+        if headers.get('X-RateLimit-Global'):
+          self.paused_until = time.monotonic() + delay
+        self.retried += 1
+        await asyncio.sleep(delay)
+
+
+class SendDispatcher:
+  """
+    Queues outgoing posts per channel and sends them from a fixed pool of workers, owned by the
+    Confessions cog
+
+    Each channel has at most one post in flight, matching Discord's per-channel rate limit buckets.
+    Workers take turns between guilds, and then between the channels of each guild, so one busy
+    channel can't hold everyone else up. Rate limits that make it past discord.py are retried with
+    backoff.
+  """
+  def __init__(self, *, workers:int, retries:int):
+    """
+      Parameters
+      ----------
+      workers: Number of posts that can be in flight at once
+      retries: Number of times a rate limited post is retried before giving up
+    """
+    self.worker_count = workers
+    self.backoff = RateLimitBackoff(retries)
+    self.queues:dict[int, deque[tuple[Callable[[], Awaitable], asyncio.Future, float]]] = {}
+    self.channel_guild:dict[int, int] = {}
+    self.guild_channels:dict[int, deque[int]] = {}
+    self.ready:deque[int] = deque()
+    self.wakeup:asyncio.Event | None = None
+    self.workers:list[asyncio.Task] = []
+    self.sent = 0
+    self.failed = 0
+    self.total_wait = 0.0
+    self.max_wait = 0.0
+
+  async def start(self):
+    """ Starts the workers, must be called from within the event loop """
+    if self.workers:
+      return
+    self.wakeup = asyncio.Event()
+    self.workers = [asyncio.create_task(self.worker()) for _ in range(self.worker_count)]
+
+  async def close(self):
+    """ Stops the workers and cancels anything still queued """
+    for task in self.workers:
+      task.cancel()
+    await asyncio.gather(*self.workers, return_exceptions=True)
+    self.workers = []
+    for queue in self.queues.values():
+      for _, future, _ in queue:
+        future.cancel()
+    self.queues.clear()
+    self.channel_guild.clear()
+    self.guild_channels.clear()
+    self.ready.clear()
+
+  def submit(
+    self, channel:discord.abc.Messageable, factory:Callable[[], Awaitable]
+  ) -> asyncio.Future:
+    """
+      Queue a post for a channel, the returned future resolves to the result of factory()
+
+      factory is called again for each retry, so it must create a new coroutine every time
+    """
+    if not self.workers:
+      raise Exception("SendDispatcher was used before it was started or after it was closed")
+    future = asyncio.get_running_loop().create_future()
+    queue = self.queues.get(channel.id)
+    if queue is None:
+      queue = self.queues[channel.id] = deque()
+      guild = getattr(channel, 'guild', None)
+      self.channel_guild[channel.id] = guild.id if guild else 0
+      self.schedule(channel.id)
+    queue.append((factory, future, time.monotonic()))
+    return future
+
+  def schedule(self, channel_id:int):
+    """ Give a channel a turn after the other channels in its guild """
+    guild_id = self.channel_guild[channel_id]
+    if channels := self.guild_channels.get(guild_id):
+      channels.append(channel_id)
+    else:
+      self.guild_channels[guild_id] = deque((channel_id,))
+      self.ready.append(guild_id)
+    self.wakeup.set()
+
+  def next_channel(self) -> int:
+    """ Take the next channel in line, from the next guild in line """
+    guild_id = self.ready.popleft()
+    channels = self.guild_channels[guild_id]
+    channel_id = channels.popleft()
+    if channels:
+      self.ready.append(guild_id)
+    else:
+      del self.guild_channels[guild_id]
+    return channel_id
+
+  async def worker(self):
+    """ Sends posts for as long as the dispatcher is running """
+    while True:
+      while not self.ready:
+        self.wakeup.clear()
+        await self.wakeup.wait()
+      channel_id = self.next_channel()
+      queue = self.queues[channel_id]
+      factory, future, queued = queue.popleft()
+      wait = time.monotonic() - queued
+      self.total_wait += wait
+      self.max_wait = max(self.max_wait, wait)
+      try:
+        if not future.cancelled():
+          try:
+            result = await self.send(factory)
+          except asyncio.CancelledError:
+            # Resolve the future so the caller isn't left waiting forever
+            self.failed += 1
+            future.cancel()
+            raise
+          except Exception as e:
+            self.failed += 1
+            if not future.done():
+              future.set_exception(e)
+          else:
+            self.sent += 1
+            if not future.done():
+              future.set_result(result)
+      finally:
+        if queue:
+          self.schedule(channel_id)
+        else:
+          del self.queues[channel_id]
+          del self.channel_guild[channel_id]
+
+  async def send(self, factory:Callable[[], Awaitable]):
+    """ Run factory(), retrying with backoff if Discord responds with 429 Too Many Requests """
+    return await self.backoff.run(factory)
+
+  def stats(self) -> dict[str, int | float]:
+    """ Queue depth, throughput and wait time in seconds """
+    depths = [len(queue) for queue in self.queues.values()]
+    done = self.sent + self.failed
+    return {
+      'queued': sum(depths),
+      'channels': len(depths),
+      'max_depth': max(depths, default=0),
+      'sent': self.sent,
+      'failed': self.failed,
+      'retried': self.backoff.retried,
+      'avg_wait': self.total_wait / done if done else 0.0,
+      'max_wait': self.max_wait
+    }
+
+
+class SpamFilter:
+  """
+    Compiled form of [confessions] spam_flags
+
+    Flags are merged into one regular expression so content is checked in a single call, and the
+    named group that matched identifies the flag. Flags that can't be merged safely (numbered
+    backreferences and global inline flags) are checked individually afterwards.
+  """
+  TIMEOUT = '(time budget exceeded)'
+  _backreference = re.compile(r'\\[1-9]')
+  _globalflags = re.compile(r'\(\?[aiLmsux]+\)')
+
+  def __init__(self, *, budget:float):
+    """
+      Parameters
+      ----------
+      budget: Seconds a single check may run for before the content is treated as spam
+    """
+    self.budget = budget
+    self.raw:str | None = None
+    self.flags:list[str] = []
+    self.combined:regex.Pattern | None = None
+    self.separate:list[tuple[int, regex.Pattern]] = []
+    self.hits:dict[str, int] = {}
+    self.checks = 0
+    self.timeouts = 0
+
+  def load(self, raw:str):
+    """ Compiles spam flags, does nothing if they haven't changed since the last call """
+    if raw == self.raw:
+      return
+    flags = [f for f in raw.splitlines() if f]
+    merge:list[tuple[int, regex.Pattern, str]] = []
+    separate:list[tuple[int, regex.Pattern]] = []
+    for i, flag in enumerate(flags):
+      try:
+        pattern = regex.compile(flag)
+      except regex.error as e:
+        print(f" - WARN: Skipping invalid spam flag {flag!r}; {e}")
+        continue
+      if self._backreference.search(flag) or self._globalflags.search(flag):
+        separate.append((i, pattern))
+      else:
+        merge.append((i, pattern, f'(?P<f{i}>{flag})'))
+
+    combined = None
+    if merge:
+      try:
+        combined = regex.compile('|'.join(group for _, _, group in merge))
+      except regex.error:
+        # Flags that are valid alone can still clash when merged, eg. duplicate group names
+        separate += [(i, pattern) for i, pattern, _ in merge]
+        separate.sort(key=lambda s: s[0])
+
+    self.raw = raw
+    self.flags = flags
+    self.combined = combined
+    self.separate = separate
+    self.hits = {flag: self.hits.get(flag, 0) for flag in flags}
+
+  def match(self, content:str) -> str | None:
+    """
+      Returns the first spam flag that matches the start of the content, if any
+      Raises TimeoutError if this takes longer than the budget
+    """
+    deadline = time.perf_counter() + self.budget
+    if self.combined and (
+      m := self.combined.match(content, timeout=self.budget, concurrent=True)
+    ):
+      return self.flags[int(m.lastgroup[1:])]
+    for i, pattern in self.separate:
+      if pattern.match(content, timeout=max(deadline - time.perf_counter(), 0), concurrent=True):
+        return self.flags[i]
+    return None
+
+  async def check(self, content:str) -> str | None:
+    """
+      Runs match() in a thread so the event loop is never blocked
+      Content that can't be checked in time is reported as SpamFilter.TIMEOUT
+    """
+    self.checks += 1
+    try:
+      flag = await asyncio.to_thread(self.match, content)
+    except TimeoutError:
+      self.timeouts += 1
+      return self.TIMEOUT
+    if flag is not None:
+      self.hits[flag] = self.hits.get(flag, 0) + 1
+    return flag
+
+  def stats(self) -> dict[str, int | dict[str, int]]:
+    """ Check counters and hits per flag """
+    return {'checks': self.checks, 'timeouts': self.timeouts, 'hits': dict(self.hits)}
+
+
 class Crypto:
   """ Handles encryption and decryption of sensitive data """
   _key = None
@@ -454,13 +1239,335 @@ class Crypto:
     return rawdata
 
 
-referenced_message_cache:OrderedDict[int, discord.Message] = {}
+class AnonIdCache:
+  """
+    Bounded LRU cache of anon-ids, keyed by (guild_id, user_id, salt version)
+
+    Decoded salts are also kept per guild. When a guild's salt changes, its version is bumped so all
+    of its cached anon-ids stop matching at once, they then age out of the LRU naturally.
+  """
+  def __init__(self, size:int):
+    self.anonids:BoundedLRU[tuple[int, int, int], str] = BoundedLRU(size)
+    self.salts:dict[int, bytes] = {}
+    self.versions:dict[int, int] = {}
+    self.hits = 0
+    self.misses = 0
+
+  def get(self, key:tuple[int, int, int]) -> str | None:
+    """ Returns a cached anon-id and marks it as recently used """
+    anonid = self.anonids.get(key)
+    if anonid is None:
+      self.misses += 1
+      return None
+    self.hits += 1
+    return anonid
+
+  def put(self, key:tuple[int, int, int], anonid:str):
+    """ Stores an anon-id, evicting the least recently used one if full """
+    self.anonids.put(key, anonid)
+
+  def invalidate(self, guild_id:int):
+    """ Forget the salt of a guild and orphan all of its anon-ids """
+    self.salts.pop(guild_id, None)
+    self.versions[guild_id] = self.versions.get(guild_id, 0) + 1
+
+  def stats(self) -> dict[str, int]:
+    """ Hit and miss counters """
+    return {'hits': self.hits, 'misses': self.misses, 'size': len(self.anonids)}
+
+
+anonid_cache = AnonIdCache(10_000)
+
+
+class FloodBucket:
+  """ A token bucket for one guild or channel """
+  def __init__(self, capacity:float, now:float):
+    self.tokens = capacity
+    self.last = now
+    # When the bucket will have refilled completely
+    self.full_at = now
+    self.allowed = 0
+    self.limited = 0
+
+
+class FloodControl:
+  """
+    Token buckets that limit how fast confessions can be sent to each guild and each channel
+
+    Limits are written as "count/seconds", a guild can lower the defaults with
+    {guild_id}_flood_guild and {guild_id}_flood_channel, but never raise them. Buckets that have
+    refilled completely are forgotten once there are too many of them.
+  """
+  def __init__(self, size:int):
+    self.size = size
+    self.buckets:dict[tuple[str, int], FloodBucket] = {}
+    self.limits:dict[str, tuple[tuple[str, str], tuple[float, float]]] = {}
+
+  @staticmethod
+  def parse_limit(raw:str) -> tuple[float, float]:
+    """ Returns (capacity, tokens per second) for "count/seconds", or zeroes if it is disabled """
+    try:
+      count, seconds = (float(n) for n in raw.split('/'))
+    except ValueError:
+      return (0.0, 0.0)
+    return (count, count / seconds) if count > 0 and seconds > 0 else (0.0, 0.0)
+
+  def get_limit(self, config:SectionProxy, key:str, default:str) -> tuple[float, float]:
+    """
+      Returns (capacity, tokens per second) for a guild, parsing only if the config changed
+
+      Guild overrides are clamped to the default so no guild can use more than its share of the
+      bot's rate limits
+    """
+    raw = (config.get(key, fallback=''), config.get(default, fallback=''))
+    cached = self.limits.get(key)
+    if cached and cached[0] == raw:
+      return cached[1]
+    limit = self.parse_limit(raw[1])
+    if raw[0]:
+      override = self.parse_limit(raw[0])
+      if not limit[0]:
+        limit = override
+      elif override[0]:
+        limit = (min(override[0], limit[0]), min(override[1], limit[1]))
+    self.limits[key] = (raw, limit)
+    return limit
+
+  def refill(self, key:tuple[str, int], limit:tuple[float, float], now:float) -> FloodBucket:
+    """ Returns a bucket with tokens added for the time since it was last used """
+    capacity, rate = limit
+    bucket = self.buckets.get(key)
+    if bucket is None:
+      if len(self.buckets) >= self.size:
+        self.sweep(now)
+      bucket = self.buckets[key] = FloodBucket(capacity, now)
+    else:
+      bucket.tokens = min(capacity, bucket.tokens + (now - bucket.last) * rate)
+      bucket.last = now
+    return bucket
+
+  def take(self, config:SectionProxy, channel:discord.abc.GuildChannel) -> float:
+    """
+      Take a token from the guild and channel buckets of this channel
+
+      Returns 0 if the confession can be sent, otherwise the seconds until it could be
+    """
+    now = time.monotonic()
+    guild_id = channel.guild.id
+    checks:list[tuple[FloodBucket, tuple[float, float]]] = []
+    for kind, key in (('guild', guild_id), ('channel', channel.id)):
+      limit = self.get_limit(config, f'{guild_id}_flood_{kind}', f'flood_{kind}')
+      if limit[0]:
+        checks.append((self.refill((kind, key), limit, now), limit))
+
+    # Only spend tokens if every bucket has one to spare
+    wait = max((
+      (1 - bucket.tokens) / limit[1] for bucket, limit in checks if bucket.tokens < 1
+    ), default=0)
+    for bucket, (capacity, rate) in checks:
+      if wait:
+        bucket.limited += 1
+      else:
+        bucket.tokens -= 1
+        bucket.full_at = now + (capacity - bucket.tokens) / rate
+        bucket.allowed += 1
+    return wait
+
+  def sweep(self, now:float):
+    """ Forget buckets that would have refilled completely by now """
+    self.buckets = {key: bucket for key, bucket in self.buckets.items() if bucket.full_at > now}
+
+  def stats(self) -> dict[str, dict[str, float]]:
+    """ Tokens left, confessions allowed and confessions limited for each bucket """
+    return {
+      f'{kind}:{key}': {'tokens': bucket.tokens, 'allowed': bucket.allowed, 'limited': bucket.limited}
+      for (kind, key), bucket in self.buckets.items()
+    }
+
+
+class CooldownStore:
+  """
+    Per-user cooldowns that expire on their own
+
+    Expiry times are kept in a heap, so expired users are swept in order as new cooldowns are added.
+    If the store is still full after a sweep, the cooldowns that were due to end soonest are dropped.
+  """
+  def __init__(self, size:int):
+    self.size = size
+    self.expiry:dict[int, float] = {}
+    self.heap:list[tuple[float, int]] = []
+    self.limited = 0
+
+  def check(self, user_id:int, cooldown:float) -> float:
+    """
+      Start a cooldown for this user if they don't have one
+
+      Returns the seconds remaining if the user is already on cooldown, 0 otherwise
+    """
+    now = time.time()
+    if (expiry := self.expiry.get(user_id)) and expiry > now:
+      self.limited += 1
+      return expiry - now
+    self.sweep(now)
+    self.expiry[user_id] = now + cooldown
+    heapq.heappush(self.heap, (now + cooldown, user_id))
+    return 0
+
+  def sweep(self, now:float):
+    """ Drop expired cooldowns, and the closest to expiry if the store is over capacity """
+    while self.heap and (self.heap[0][0] <= now or len(self.heap) >= self.size):
+      expiry, user_id = heapq.heappop(self.heap)
+      if self.expiry.get(user_id) == expiry:
+        del self.expiry[user_id]
+
+  def stats(self) -> dict[str, int]:
+    """ Size of the store and number of blocked attempts """
+    return {'size': len(self.expiry), 'limited': self.limited}
+
+
+class VisibilityCache:
+  """
+    Bounded LRU cache of whether a set of roles can read a channel
+
+    Keyed by (guild_id, guild version, channel_id, channel version, role ids). Role changes bump the
+    guild version and overwrite changes bump the channel version, orphaned entries age out of the
+    LRU. Guild owners and members with their own overwrites on a channel are never cached.
+  """
+  def __init__(self, size:int):
+    self.visible:BoundedLRU[tuple[int, int, int, int, frozenset[int]], bool] = BoundedLRU(size)
+    self.member_overwrites:dict[int, frozenset[int]] = {}
+    self.versions:dict[int, int] = {}
+    self.hits = 0
+    self.misses = 0
+    self.bypassed = 0
+
+  def can_read(self, channel:discord.abc.GuildChannel, member:discord.Member) -> bool:
+    """ Equivalent to channel.permissions_for(member).read_messages """
+    if channel.id not in self.member_overwrites:
+      self.member_overwrites[channel.id] = frozenset(
+        target.id for target in channel.overwrites if not isinstance(target, discord.Role)
+      )
+    if member.id == channel.guild.owner_id or member.id in self.member_overwrites[channel.id]:
+      self.bypassed += 1
+      return channel.permissions_for(member).read_messages
+
+    key = (
+      channel.guild.id, self.versions.get(channel.guild.id, 0),
+      channel.id, self.versions.get(channel.id, 0),
+      frozenset(role.id for role in member.roles)
+    )
+    visible = self.visible.get(key)
+    if visible is not None:
+      self.hits += 1
+      return visible
+    self.misses += 1
+    visible = channel.permissions_for(member).read_messages
+    self.visible.put(key, visible)
+    return visible
+
+  def invalidate_guild(self, guild_id:int):
+    """ Orphan every cached result in a guild, for when roles change """
+    self.versions[guild_id] = self.versions.get(guild_id, 0) + 1
+
+  def invalidate_channel(self, channel_id:int):
+    """ Orphan every cached result for a channel, for when overwrites change """
+    self.member_overwrites.pop(channel_id, None)
+    self.versions[channel_id] = self.versions.get(channel_id, 0) + 1
+
+  def stats(self) -> dict[str, int]:
+    """ Hit and miss counters """
+    return {
+      'hits': self.hits, 'misses': self.misses, 'bypassed': self.bypassed, 'size': len(self.visible)
+    }
+
+
+visibility_cache = VisibilityCache(50_000)
+
+
+class ReferenceCache:
+  """
+    Remembers which channel a replied-to message is in, so replies can be restored after vetting
+
+    Only (channel_id, message_id) pairs are stored. Entries are evicted once the cache is full,
+    least recently used first, or once they are older than the ttl.
+  """
+  def __init__(self, size:int, ttl:float):
+    self.ttl = ttl
+    self.entries:BoundedLRU[int, tuple[int, float]] = BoundedLRU(size)
+    self.hits = 0
+    self.misses = 0
+    self.expired = 0
+
+  def put(self, message:discord.Message | discord.PartialMessage):
+    """ Remember the channel of a referenced message """
+    # Chances are evicted items are not going to be approved or denied
+    # It's also possible the vet message is deleted
+    self.entries.put(message.id, (message.channel.id, time.monotonic() + self.ttl))
+
+  def get(self, message_id:int) -> int | None:
+    """ Returns the channel id of a referenced message if it's still known """
+    entry = self.entries.get(message_id)
+    if entry is None:
+      self.misses += 1
+      return None
+    channel_id, expiry = entry
+    if expiry < time.monotonic():
+      del self.entries[message_id]
+      self.expired += 1
+      self.misses += 1
+      return None
+    self.hits += 1
+    return channel_id
+
+  def stats(self) -> dict[str, int]:
+    """ Hit, miss and expiry counters """
+    return {
+      'hits': self.hits, 'misses': self.misses, 'expired': self.expired, 'size': len(self.entries)
+    }
+
+
+referenced_message_cache = ReferenceCache(10_000, 7 * 24 * 60 * 60)
+
+
+class ResolutionStats:
+  """ Cache hits and latency when resolving users and channels for stored confessions """
+  def __init__(self):
+    self.hits = 0
+    self.misses = 0
+    self.resolutions = 0
+    self.total_time = 0.0
+    self.max_time = 0.0
+
+  def record(self, *, hits:int, misses:int, elapsed:float):
+    """ Add the outcome of one resolution """
+    self.hits += hits
+    self.misses += misses
+    self.resolutions += 1
+    self.total_time += elapsed
+    self.max_time = max(self.max_time, elapsed)
+
+  def stats(self) -> dict[str, int | float]:
+    """ Hit ratio and latency in seconds """
+    lookups = self.hits + self.misses
+    return {
+      'hits': self.hits,
+      'misses': self.misses,
+      'hit_ratio': self.hits / lookups if lookups else 0.0,
+      'avg_latency': self.total_time / self.resolutions if self.resolutions else 0.0,
+      'max_latency': self.max_time
+    }
+
+
+resolution_stats = ResolutionStats()
 
 
 class ConfessionData:
   """ Dataclass for Confessions """
   SCOPE = 'confessions' # exists to keep babel happy
   DATA_VERSION = 2
+  IMAGE_SIZE_LIMIT = 25_000_000 # Discord size limit
+  IMAGE_SPOOL_SIZE = 2_000_000 # Images larger than this are downloaded to a temporary file
+  IMAGE_CHUNK_SIZE = 64 * 1024
   anonid:str | None
   author:discord.User
   targetchannel:discord.TextChannel
@@ -470,6 +1577,7 @@ class ConfessionData:
   attachment:discord.Attachment | None = None
   file:discord.File | None = None
   embed:discord.Embed | None = None
+  message:discord.Message | None = None
   channeltype:ChannelType
   targetchanneltype:ChannelType
 
@@ -483,8 +1591,12 @@ class ConfessionData:
 
   # Data retreival
 
-  async def from_binary(self, crypto:Crypto, rawdata:str):
-    """ Creates ConfessionData from an encrypted binary string """
+  async def from_binary(self, crypto:Crypto, rawdata:str, reference_channel_id:int | None = None):
+    """
+      Creates ConfessionData from an encrypted binary string
+
+      reference_channel_id restores replies that are no longer in referenced_message_cache
+    """
     binary = crypto.decrypt(b64decode(rawdata))
     if len(binary) == 26:
       data_version = int.from_bytes(bytes((binary[0],)), 'big')
@@ -499,15 +1611,37 @@ class ConfessionData:
       reference_id = int.from_bytes(binary[18:26], 'big')
     else:
       raise CorruptConfessionDataException("Data format incorrect;", len(binary), "!=", 26)
-    self.author = await self.bot.fetch_user(author_id)
-    self.targetchannel = await self.bot.fetch_channel(targetchannel_id)
+    # Prefer the gateway cache, only fall back to the API on a miss
+    start = time.perf_counter()
+    author = self.bot.get_user(author_id)
+    targetchannel = self.bot.get_channel(targetchannel_id)
+    misses = (author is None) + (targetchannel is None)
+    if misses:
+      author, targetchannel = await asyncio.gather(
+        self._cached_or_fetch(author, self.bot.fetch_user, author_id),
+        self._cached_or_fetch(targetchannel, self.bot.fetch_channel, targetchannel_id)
+      )
+    resolution_stats.record(hits=2 - misses, misses=misses, elapsed=time.perf_counter() - start)
+    self.author = author
+    self.targetchannel = targetchannel
     self.anonid = self.get_anonid(self.targetchannel.guild.id, self.author.id)
     guildchannels = get_guildchannels(self.config, self.targetchannel.guild.id)
     self.channeltype = guildchannels.get(self.targetchannel.id, ChannelType.unset)
     self.targetchanneltype = self.channeltype
-    # References must exist in the cache, meaning confession replies will not survive a restart
-    # Note: this assumes the data will only be retreived once
-    self.reference = referenced_message_cache.pop(reference_id, None)
+    # References must exist in the cache or the PendingStore to be restored
+    self.reference = None
+    if reference_id and (
+      channel_id := referenced_message_cache.get(reference_id) or reference_channel_id
+    ):
+      channel = (
+        self.bot.get_channel(channel_id) or
+        self.bot.get_partial_messageable(channel_id, guild_id=self.targetchannel.guild.id)
+      )
+      self.reference = channel.get_partial_message(reference_id)
+
+  @staticmethod
+  async def _cached_or_fetch(cached, fetch:Callable[[int], Awaitable], object_id:int):
+    return cached if cached is not None else await fetch(object_id)
 
   def create(
     self,
@@ -544,21 +1678,63 @@ class ConfessionData:
           self.content = embed.description
 
   async def add_image(self, *, attachment:discord.Attachment | None = None, url:str | None = None):
-    """ Download image so it can be reuploaded with message """
-    async with aiohttp.ClientSession() as session:
-      async with session.get(attachment.url if attachment else url) as res:
-        if res.status == 200:
-          filename = 'file.'+res.content_type.replace('image/','')
-          self.file = discord.File(
-            io.BytesIO(await res.read()),
-            filename
-          )
-          if self.embed:
-            self.embed.set_image(url='attachment://'+self.file.filename)
-          if attachment:
-            self.attachment = attachment
-        else:
-          raise Exception("Failed to download image!")
+    """
+      Download image so it can be reuploaded with message
+
+      The image is streamed in chunks, small images stay in memory and larger ones are moved to a
+      temporary file. Downloads are abandoned as soon as they are known to be invalid.
+    """
+    session:SharedSession = self.bot.cogs['Confessions'].session
+    async with session.get(attachment.url if attachment else url) as res:
+      if res.status != 200:
+        raise Exception("Failed to download image!")
+      if not res.content_type.startswith('image/'):
+        raise commands.BadArgument("Expected an image, got " + res.content_type)
+      if res.content_length is not None and res.content_length >= self.IMAGE_SIZE_LIMIT:
+        raise commands.BadArgument("Image is larger than the size limit")
+      filename = 'file.'+res.content_type.replace('image/','')
+      buffer:io.IOBase = io.BytesIO()
+      size = 0
+      try:
+        async for chunk in res.content.iter_chunked(self.IMAGE_CHUNK_SIZE):
+          size += len(chunk)
+          if size >= self.IMAGE_SIZE_LIMIT:
+            raise commands.BadArgument("Image is larger than the size limit")
+          if size > self.IMAGE_SPOOL_SIZE and isinstance(buffer, io.BytesIO):
+            spill = tempfile.TemporaryFile()
+            # On some platforms this is a wrapper which discord.File won't accept
+            if isinstance(spill, io.IOBase):
+              with buffer.getbuffer() as view:
+                spill.write(view)
+              buffer.close()
+              buffer = spill
+            else:
+              spill.close()
+          buffer.write(chunk)
+      except BaseException:
+        buffer.close()
+        raise
+      buffer.seek(0)
+
+    self.attach_file(discord.File(buffer, filename))
+    if attachment:
+      self.attachment = attachment
+
+  def attach_file(self, file:discord.File):
+    """ Use an image that is already available instead of downloading it """
+    self.release_image()
+    self.file = file
+    if self.embed:
+      self.embed.set_image(url='attachment://'+self.file.filename)
+
+  def release_image(self) -> bool:
+    """ Frees the memory or temporary file holding a downloaded image, returns True if there was one """
+    if self.file is None:
+      return False
+    self.file.close()
+    self.file.fp.close()
+    self.file = None
+    return True
 
   # Data storage
 
@@ -572,12 +1748,7 @@ class ConfessionData:
     if self.reference:
       breference = self.reference.id.to_bytes(8, 'big')
       # Store in cache so it can be restored
-      referenced_message_cache[self.reference.id] = self.reference
-      # Prevent a memory leak
-      if len(referenced_message_cache) > 100:
-        # Chances are older items in this list are not going to be approved or denied
-        # It's also possible the vet message is deleted
-        referenced_message_cache.popitem(last=False)
+      referenced_message_cache.put(self.reference)
     else:
       breference = int(0).to_bytes(8, 'big')
 
@@ -588,14 +1759,22 @@ class ConfessionData:
 
   def get_anonid(self, guildid:int, userid:int) -> str:
     """ Calculates the current anon-id for a user """
-    salt = b64decode(self.config.get(f"{guildid}_shuffle", fallback=''))
-    if len(salt) < 16: # If server does not yet have a salt
-      salt = self.parent.crypto.srandom_token()
-      self.config[f"{guildid}_shuffle"] = b64encode(salt).decode('ascii')
+    key = (guildid, userid, anonid_cache.versions.get(guildid, 0))
+    if anonid := anonid_cache.get(key):
+      return anonid
+    salt = anonid_cache.salts.get(guildid)
+    if salt is None:
+      salt = b64decode(self.config.get(f"{guildid}_shuffle", fallback=''))
+      if len(salt) < 16: # If server does not yet have a salt
+        salt = self.parent.crypto.srandom_token()
+        self.config[f"{guildid}_shuffle"] = b64encode(salt).decode('ascii')
+      anonid_cache.salts[guildid] = salt
     hashed = self.parent.crypto.hash(
       guildid.to_bytes(8, 'big') + userid.to_bytes(8, 'big'), salt
     )
-    return hashed.hex()[-6:]
+    anonid = hashed.hex()[-6:]
+    anonid_cache.put(key, anonid)
+    return anonid
 
   def generate_embed(self):
     """ Generate or add anonid to the confession embed """
@@ -614,28 +1793,25 @@ class ConfessionData:
 
   def check_banned(self) -> bool:
     """ Verify the user hasn't been banned """
-    guild_id = self.targetchannel.guild.id
-    if self.anonid in self.config.get(f"{guild_id}_banned", fallback='').split(','):
-      return False
-    return True
+    return self.anonid not in ban_index.get(self.config, self.targetchannel.guild.id)
 
   def check_image(self) -> bool:
     """ Only allow images to be sent if imagesupport is enabled and the image is valid """
     image = self.attachment
     guild_id = self.targetchannel.guild.id
-    if image and image.content_type.startswith('image') and image.size < 25_000_000:
-      # Discord size limit
+    if image and image.content_type.startswith('image') and image.size < self.IMAGE_SIZE_LIMIT:
       if bool(self.config.get(f"{guild_id}_imagesupport", fallback=True)):
         return True
       return False
     raise commands.BadArgument()
 
-  def check_spam(self):
+  async def check_spam(self) -> bool:
     """ Verify message doesn't contain spam as defined in [confessions] spam_flags """
-    for spamflag in self.config.get('spam_flags', fallback=None).splitlines():
-      if self.content and re.match(spamflag, self.content):
-        return False
-    return True
+    if not self.content:
+      return True
+    spam_filter:SpamFilter = self.bot.cogs['Confessions'].spam_filter
+    spam_filter.load(self.config.get('spam_flags', fallback=''))
+    return await spam_filter.check(self.content) is None
 
   async def check_vetting(
     self,
@@ -643,8 +1819,7 @@ class ConfessionData:
   ) -> discord.TextChannel | bool | None:
     """ Check if vetting is required, this is not a part of check_all """
     send = (inter.followup.send if inter.response.is_done() else inter.response.send_message)
-    guildchannels = get_guildchannels(self.config, self.targetchannel.guild.id)
-    vetting = findvettingchannel(guildchannels)
+    vetting = findvettingchannel(self.config, self.targetchannel.guild.id)
     if vetting and self.targetchanneltype.vetted:
       if 'ConfessionsModeration' not in self.bot.cogs:
         await send(self.babel(inter, 'no_moderation'), ephemeral=True)
@@ -691,7 +1866,7 @@ class ConfessionData:
         await send(self.babel(inter, 'invalidimage'), **kwargs)
         return False
 
-    if not self.check_spam():
+    if not await self.check_spam():
       await send(self.babel(inter, 'nospam'), **kwargs)
       return False
 
@@ -699,15 +1874,20 @@ class ConfessionData:
 
   # Sending
 
-  async def handle_send_errors(self, inter:discord.Interaction, func):
+  async def handle_send_errors(
+    self,
+    inter:discord.Interaction,
+    channel:discord.TextChannel,
+    factory:Callable[[], Awaitable]
+  ):
     """
-    Wraps around functions that send confessions to channels
+    Queues a function that sends confessions to channels with the SendDispatcher
     Adds copious amounts of error handling
     """
     send = (inter.followup.send if inter.response.is_done() else inter.response.send_message)
     kwargs = {'ephemeral':True}
     try:
-      await func
+      self.message = await self.bot.cogs['Confessions'].dispatcher.submit(channel, factory)
       return True
     except discord.Forbidden:
       try:
@@ -756,6 +1936,12 @@ class ConfessionData:
     if perform_checks:
       if not await self.check_all(inter):
         return False
+      confessions:Confessions = self.bot.cogs['Confessions']
+      if wait := confessions.flood_control.take(self.config, channel):
+        await inter.followup.send(
+          self.babel(inter, 'flood_slowdown', time=math.ceil(wait)), ephemeral=True
+        )
+        return False
     preface = (
       preface_override if preface_override is not None
       else self.config.get(f'{channel.guild.id}_preface', fallback='')
@@ -789,7 +1975,7 @@ class ConfessionData:
       # A best effort to always show replies, even if Discord's API doesn't allow for it
       # Discord does not allow webhooks to reply, disable it
       use_webhook = False
-      if self.reference.channel == channel:
+      if self.reference.channel.id == channel.id:
         kwargs['reference'] = discord.MessageReference(
           message_id=self.reference.id, channel_id=channel.id, fail_if_not_exists=False
         )
@@ -809,22 +1995,39 @@ class ConfessionData:
           self.config.get('pfpgen_url', '')
           .replace('{}', self.anonid if self.channeltype.anonid else botcolour)
         )
-        func = webhook.send(self.content, username=username, avatar_url=pfp, **kwargs)
+
+        def func():
+          return self.send_webhook(
+            channel, webhook, self.content, username=username, avatar_url=pfp, **kwargs
+          )
         #TODO: add support for custom PFPs
       else:
         return False
     else:
       self.generate_embed()
-      func = channel.send(preface, embed=self.embed, **kwargs)
-    success = await self.handle_send_errors(inter, func)
+
+      def func():
+        return channel.send(preface, embed=self.embed, **kwargs)
+    success = await self.handle_send_errors(inter, channel, self.retry_factory(func))
+    attached = self.file is not None
+    if success:
+      # The image has been uploaded now, don't hold onto it
+      # On failure the owner of this ConfessionData may still retry, so it must release it
+      self.release_image()
 
     if 'Log' in self.bot.cogs and channel == self.targetchannel:
       logentry = (
         f'{self.targetchannel.guild.name}/{self.anonid} ({self.author.name}): ' +
-        self.bot.utilities.truncate(self.content) + (' (attachment)' if self.file else '')
+        self.bot.utilities.truncate(self.content) + (' (attachment)' if attached else '')
       )
       await self.bot.cogs['Log'].log_misc_str(content=logentry)
 
+    # Let external modules know what was sent
+    if success and channel == self.targetchannel and self.channeltype.dep in self.bot.cogs:
+      sent_function = getattr(self.bot.cogs[self.channeltype.dep], 'on_channeltype_sent', None)
+      if callable(sent_function):
+        await sent_function(inter, self)
+
     # Mark the command as complete by sending a success message
     if success and success_message:
       if inter.channel != self.targetchannel: # confess-to
@@ -836,17 +2039,53 @@ class ConfessionData:
         await inter.followup.send(self.babel(inter, 'confession_sent_below'), ephemeral=True)
     return success
 
+  def retry_factory(self, func:Callable[[], Awaitable]) -> Callable[[], Awaitable]:
+    """ Rewinds the image before every attempt, as a failed send may have read it already """
+    def factory():
+      if self.file:
+        self.file.reset()
+      return func()
+    return factory
+
   async def find_or_create_webhook(self, channel:discord.TextChannel) -> discord.Webhook | None:
-    """ Tries to find a webhook, or create it, or complain about missing permissions """
+    """
+      Tries to find a webhook, or create it, or complain about missing permissions
+      Webhooks are cached per channel, so this usually doesn't need any requests
+    """
+    confessions:Confessions = self.bot.cogs['Confessions']
+    if channel.id in confessions.webhook_cache:
+      return confessions.webhook_cache[channel.id]
     webhook:discord.Webhook
     try:
       for webhook in await channel.webhooks():
         if webhook.user == self.bot.user:
-          return webhook
-      return await channel.create_webhook(name=self.bot.config['main']['botname'])
+          break
+      else:
+        webhook = await channel.create_webhook(name=self.bot.config['main']['botname'])
     except discord.Forbidden:
       await channel.send(self.babel(channel.guild, 'missingperms', perm='Manage Webhooks'))
       return None
+    # Uses discord.py's own HTTP session, the image download pool's timeouts don't suit uploads
+    webhook = discord.Webhook.partial(webhook.id, webhook.token, client=self.bot)
+    confessions.webhook_cache[channel.id] = webhook
+    return webhook
+
+  async def send_webhook(
+    self, channel:discord.TextChannel, webhook:discord.Webhook, content:str | None, **kwargs
+  ):
+    """ Sends with a cached webhook, replacing it once if it no longer exists """
+    try:
+      return await webhook.send(content, **kwargs)
+    except discord.NotFound as e:
+      if e.code != 10015: # Unknown Webhook
+        raise
+      self.bot.cogs['Confessions'].webhook_cache.pop(channel.id, None)
+      webhook = await self.find_or_create_webhook(channel)
+      if webhook is None:
+        raise
+      if 'file' in kwargs:
+        kwargs['file'].reset()
+      return await webhook.send(content, **kwargs)
 
 
 async def setup(_):
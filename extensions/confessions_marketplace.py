@@ -15,7 +15,9 @@ if TYPE_CHECKING:
   from babel import Resolvable
   from configparser import SectionProxy
 
-from overlay.extensions.confessions_common import ChannelType, get_guildchannels, ConfessionData
+from overlay.extensions.confessions_common import (
+  BoundedLRU, ChannelType, get_guildchannels, ConfessionData
+)
 
 
 class MarketplaceFlags(IntEnum):
@@ -24,6 +26,66 @@ class MarketplaceFlags(IntEnum):
   OFFER = 2
 
 
+class Listing:
+  """ What offers and sales need to know about a listing, without fetching it """
+  def __init__(self, id_seller:str, embed:discord.Embed, active:bool = True):
+    self.id_seller = id_seller
+    self.embed = embed
+    self.active = active
+    self.offers = 0
+    self.sales = 0
+
+  @property
+  def title(self) -> str:
+    return self.embed.title
+
+  @classmethod
+  def from_message(cls, message:discord.Message) -> Listing | None:
+    """ Read a listing from its message, returns None if it isn't a listing """
+    if len(message.embeds) == 0:
+      return None
+    if message.components:
+      custom_id = message.components[0].children[0].custom_id
+      if not custom_id.startswith('confessionmarketplace_offer_'):
+        return None
+      return cls(custom_id[28:], message.embeds[0])
+    # The buttons are removed when a listing is withdrawn
+    return cls('', message.embeds[0], active=False)
+
+
+class ListingIndex:
+  """
+    Listings by message id, kept in an LRU so offers and sales don't need to fetch the listing,
+    owned by the ConfessionsMarketplace cog
+  """
+  def __init__(self, size:int):
+    self.listings:BoundedLRU[int, Listing] = BoundedLRU(size)
+    self.hits = 0
+    self.misses = 0
+
+  def add(self, message_id:int, listing:Listing):
+    self.listings.put(message_id, listing)
+
+  def peek(self, message_id:int) -> Listing | None:
+    """ Returns a listing if it is indexed, without fetching it """
+    return self.listings.peek(message_id)
+
+  async def get(self, channel:discord.abc.Messageable, message_id:int) -> Listing | None:
+    """ Returns a listing, only fetching its message if it isn't indexed """
+    if (listing := self.listings.get(message_id)) is not None:
+      self.hits += 1
+      return listing
+    self.misses += 1
+    listing = Listing.from_message(await channel.fetch_message(message_id))
+    if listing is not None:
+      self.add(message_id, listing)
+    return listing
+
+  def stats(self) -> dict[str, int]:
+    """ Hit and miss counters """
+    return {'size': len(self.listings), 'hits': self.hits, 'misses': self.misses}
+
+
 class ConfessionsMarketplace(commands.Cog):
   """ Enable anonymous trade """
   SCOPE = 'confessions'
@@ -42,6 +104,13 @@ class ConfessionsMarketplace(commands.Cog):
 
     if 'confessions' not in bot.config['extensions']:
       raise Exception("Module `confessions` must be enabled!")
+    if 'listing_cache_size' not in self.config:
+      self.config['listing_cache_size'] = '10000'
+    self.listings = ListingIndex(self.config.getint('listing_cache_size'))
+
+  async def stats(self) -> dict[str, dict]:
+    """ Counters of this cog's caches, collected by Confessions.stats """
+    return {'listings': self.listings.stats()}
 
   # Modals
 
@@ -173,8 +242,12 @@ class ConfessionsMarketplace(commands.Cog):
     await inter.response.send_modal(self.OfferModal(self, inter))
 
   async def on_accept_offer(self, inter:discord.Interaction):
-    listing = await inter.channel.fetch_message(inter.message.reference.message_id)
-    if len(listing.embeds) == 0 or len(inter.message.embeds) == 0:
+    listing_id = inter.message.reference.message_id
+    try:
+      listing = await self.listings.get(inter.channel, listing_id)
+    except discord.NotFound:
+      listing = None
+    if listing is None or len(inter.message.embeds) == 0:
       await inter.response.send_message(self.babel(inter, 'error_embed_deleted'), ephemeral=True)
       return
     if len(inter.data.get('custom_id')) < 31:
@@ -194,21 +267,23 @@ class ConfessionsMarketplace(commands.Cog):
         self.babel(inter, 'error_wrong_person', buy=True), ephemeral=True
       )
       return
-    receipts = [listing.embeds[0], inter.message.embeds[0]]
+    receipts = [listing.embed, inter.message.embeds[0]]
     await inter.response.defer()
     await seller.send(self.babel(
       inter, 'sale_complete',
-      listing=listing.embeds[0].title,
+      listing=listing.title,
       sell=True,
       other=buyer.mention
     ), embeds=receipts)
     await buyer.send(self.babel(
       inter, 'sale_complete',
-      listing=listing.embeds[0].title,
+      listing=listing.title,
       sell=True,
       other=seller.mention
     ), embeds=receipts)
     await inter.message.edit(content=self.babel(inter, 'offer_accepted'), view=None)
+    listing.offers = max(listing.offers - 1, 0)
+    listing.sales += 1
 
   async def on_withdraw(self, inter:discord.Interaction):
     encrypted_data = inter.data.get('custom_id')[31:].split('_')
@@ -224,11 +299,17 @@ class ConfessionsMarketplace(commands.Cog):
         content=self.babel(inter, 'listing_withdrawn'),
         view=None
       )
+      if listing := self.listings.peek(inter.message.id):
+        listing.active = False
     elif len(encrypted_data) == 2: # offer
       await inter.message.edit(
         content=self.babel(inter, 'offer_withdrawn'),
         view=None
       )
+      if inter.message.reference and (
+        listing := self.listings.peek(inter.message.reference.message_id)
+      ):
+        listing.offers = max(listing.offers - 1, 0)
     else:
       raise Exception("Unknown state encountered!", len(encrypted_data))
 
@@ -280,12 +361,16 @@ class ConfessionsMarketplace(commands.Cog):
       await pendingconfession.add_image(attachment=image)
     pendingconfession.channeltype_flags = MarketplaceFlags.LISTING
 
-    if vetting := await pendingconfession.check_vetting(inter):
-      await self.bot.cogs['ConfessionsModeration'].send_vetting(inter, pendingconfession, vetting)
-      return
-    if vetting is False:
-      return
-    await pendingconfession.send_confession(inter, True, webhook_override=False)
+    try:
+      if vetting := await pendingconfession.check_vetting(inter):
+        await self.bot.cogs['ConfessionsModeration'].send_vetting(inter, pendingconfession, vetting)
+        return
+      if vetting is False:
+        return
+      await pendingconfession.send_confession(inter, True, webhook_override=False)
+    finally:
+      # There is no way to retry from here, so free the image if sending failed
+      pendingconfession.release_image()
 
   # Special ChannelType code
   async def on_channeltype_send(
@@ -300,17 +385,33 @@ class ConfessionsMarketplace(commands.Cog):
         'view': self.ListingView(self, inter, id_seller)
       }
     elif data.channeltype_flags == MarketplaceFlags.OFFER:
-      listing = await data.targetchannel.fetch_message(data.reference.id)
-      id_seller = listing.components[0].children[0].custom_id[28:]
+      try:
+        listing = await self.listings.get(data.targetchannel, data.reference.id)
+      except discord.NotFound:
+        listing = None
+      if listing is None or not listing.active:
+        await inter.followup.send(self.babel(inter, 'error_embed_deleted'), ephemeral=True)
+        return False
       raw_buyer = data.parent.crypto.encrypt(data.author.id.to_bytes(8, 'big'))
       id_buyer = b64encode(raw_buyer).decode('ascii')
       return {
         'use_webhook': False,
-        'view': self.OfferView(self, inter, id_seller, id_buyer)
+        'view': self.OfferView(self, inter, listing.id_seller, id_buyer)
       }
     else:
       raise Exception("Unknown state encountered!", data.channeltype_flags)
 
+  async def on_channeltype_sent(self, _:discord.Interaction, data:ConfessionData):
+    """ Index listings as they are posted, and count the offers made on them """
+    if data.message is None:
+      return
+    if data.channeltype_flags == MarketplaceFlags.LISTING:
+      if listing := Listing.from_message(data.message):
+        self.listings.add(data.message.id, listing)
+    elif data.channeltype_flags == MarketplaceFlags.OFFER:
+      if listing := self.listings.peek(data.reference.id):
+        listing.offers += 1
+
 
 async def setup(bot:MerelyBot):
   """ Bind this cog to the bot """
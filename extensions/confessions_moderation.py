@@ -5,13 +5,16 @@
 """
 from __future__ import annotations
 
-import asyncio, re
-from typing import Optional, TYPE_CHECKING
+import asyncio, contextlib, hashlib, io, os, re, secrets, sqlite3, tempfile, threading, time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Literal, Optional, TYPE_CHECKING
 import discord
 from discord import app_commands
 from discord.ext import commands
 
 if TYPE_CHECKING:
+  from collections.abc import Awaitable, Callable
   from main import MerelyBot
   from babel import Resolvable
   from configparser import SectionProxy
@@ -19,10 +22,655 @@ if TYPE_CHECKING:
   from overlay.extensions.confessions_common import Crypto
 
 from overlay.extensions.confessions_common import (
-  ConfessionData, CorruptConfessionDataException, safe_fetch_channel
+  BoundedLRU, ConfessionData, CorruptConfessionDataException, RateLimitBackoff, ban_index,
+  findvettingchannel
 )
 
 
+class KeyedLocks:
+  """
+    An asyncio.Lock for each key, created when needed and dropped once nobody is using it
+
+    A lock that has been held for longer than timeout is treated as abandoned, the next caller gets a
+    new lock for that key instead of waiting forever.
+  """
+  def __init__(self, timeout:float):
+    self.timeout = timeout
+    # key: [lock, time acquired, callers holding or waiting]
+    self.locks:dict[str, list] = {}
+    self.acquired = 0
+    self.contended = 0
+    self.expired = 0
+    self.timeouts = 0
+
+  def locked(self, key:str) -> bool:
+    """ Returns True if the lock for key is held and hasn't expired """
+    entry = self.locks.get(key)
+    if entry is None or not entry[0].locked():
+      return False
+    if time.monotonic() - entry[1] > self.timeout:
+      self.expired += 1
+      del self.locks[key]
+      return False
+    return True
+
+  @contextlib.asynccontextmanager
+  async def hold(self, key:str):
+    """ Hold the lock for key, waiting up to timeout for it if it is taken """
+    if key in self.locks:
+      self.locked(key) # Replaces the lock if it has expired
+    entry = self.locks.setdefault(key, [asyncio.Lock(), 0.0, 0])
+    lock:asyncio.Lock = entry[0]
+    entry[2] += 1
+    try:
+      if lock.locked():
+        self.contended += 1
+        await asyncio.wait_for(lock.acquire(), self.timeout)
+      else:
+        # Acquire without yielding so a locked() check before this stays accurate
+        await lock.acquire()
+    except asyncio.TimeoutError:
+      self.timeouts += 1
+      self.release(key, entry)
+      raise
+    entry[1] = time.monotonic()
+    self.acquired += 1
+    try:
+      yield
+    finally:
+      lock.release()
+      self.release(key, entry)
+
+  def release(self, key:str, entry:list):
+    """ Drop the lock for key once there are no callers left """
+    entry[2] -= 1
+    if entry[2] <= 0 and self.locks.get(key) is entry:
+      del self.locks[key]
+
+  def stats(self) -> dict[str, int]:
+    """ Lock usage and contention counters """
+    return {
+      'held': len(self.locks), 'acquired': self.acquired, 'contended': self.contended,
+      'expired': self.expired, 'timeouts': self.timeouts
+    }
+
+
+class PendingStore:
+  """
+    Confessions waiting in vetting, stored in sqlite so they survive restarts, owned by the
+    ConfessionsModeration cog
+
+    Vetting buttons only carry a short id, the encrypted confession data lives here along with
+    everything needed to restore it on approval. All queries run on a single thread of their own
+    so sqlite never blocks the event loop, and writes never contend with each other.
+  """
+  ID_PREFIX = '#'
+
+  def __init__(self, path:str):
+    self.path = path
+    self.db:sqlite3.Connection | None = None
+    self.executor:ThreadPoolExecutor | None = None
+
+  async def run(self, func:Callable, *args):
+    """ Run a database call on the store's thread """
+    return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+
+  async def open(self):
+    """ Connects to the database, creating it if needed """
+    if self.executor:
+      return
+    self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='PendingStore')
+    await self.run(self._open)
+
+  def _open(self):
+    self.db = sqlite3.connect(self.path, check_same_thread=False)
+    self.db.execute('PRAGMA journal_mode=WAL')
+    self.db.execute(
+      """
+        CREATE TABLE IF NOT EXISTS pending (
+          id TEXT PRIMARY KEY,
+          guild_id INTEGER NOT NULL,
+          payload TEXT NOT NULL,
+          reference_channel_id INTEGER,
+          image_url TEXT,
+          vetting_message_id INTEGER,
+          status TEXT NOT NULL DEFAULT 'pending',
+          created REAL NOT NULL,
+          resolved REAL,
+          image_key TEXT
+        )
+      """
+    )
+    columns = {row[1] for row in self.db.execute('PRAGMA table_info(pending)')}
+    if 'image_key' not in columns:
+      self.db.execute('ALTER TABLE pending ADD COLUMN image_key TEXT')
+    self.db.execute('CREATE INDEX IF NOT EXISTS pending_status ON pending (status, guild_id)')
+    self.db.commit()
+
+  def close(self):
+    """ Waits for queued queries to finish, then closes the database """
+    if self.executor:
+      self.executor.submit(self._close)
+      self.executor.shutdown(wait=True)
+      self.executor = None
+
+  def _close(self):
+    if self.db:
+      self.db.close()
+      self.db = None
+
+  def _write(self, query:str, params:tuple):
+    self.db.execute(query, params)
+    self.db.commit()
+
+  def _fetch(
+    self, query:str, params:tuple, one:bool = False
+  ) -> list[sqlite3.Row] | sqlite3.Row | None:
+    cursor = self.db.execute(query, params)
+    cursor.row_factory = sqlite3.Row
+    return cursor.fetchone() if one else cursor.fetchall()
+
+  async def add(self, data:ConfessionData) -> str:
+    """ Stores a confession that is about to be vetted, returns its id """
+    pending_id = secrets.token_urlsafe(8)
+    await self.run(
+      self._write,
+      'INSERT INTO pending (id, guild_id, payload, reference_channel_id, created) '
+      'VALUES (?, ?, ?, ?, ?)',
+      (
+        pending_id,
+        data.targetchannel.guild.id,
+        data.store(),
+        data.reference.channel.id if data.reference else None,
+        time.time()
+      )
+    )
+    return pending_id
+
+  async def set_message(self, pending_id:str, message:discord.Message):
+    """ Records the vetting message and the image attached to it """
+    image_url = None
+    if message.attachments:
+      image_url = message.attachments[0].url
+    elif message.embeds and message.embeds[0].image:
+      image_url = message.embeds[0].image.url
+    await self.run(
+      self._write,
+      'UPDATE pending SET vetting_message_id = ?, image_url = ? WHERE id = ?',
+      (message.id, image_url, pending_id)
+    )
+
+  async def set_image(self, pending_id:str, image_key:str):
+    """ Records where the ImageStore is keeping the image of a stored confession """
+    await self.run(
+      self._write, 'UPDATE pending SET image_key = ? WHERE id = ?', (image_key, pending_id)
+    )
+
+  async def image_in_use(self, image_key:str) -> bool:
+    """ Returns True if any confession still waiting in vetting has this image """
+    return await self.run(
+      self._fetch,
+      'SELECT 1 FROM pending WHERE image_key = ? AND status = \'pending\' LIMIT 1',
+      (image_key,),
+      True
+    ) is not None
+
+  async def get(self, pending_id:str) -> sqlite3.Row | None:
+    """ Returns a stored confession if it hasn't been approved or denied yet """
+    return await self.run(
+      self._fetch,
+      'SELECT * FROM pending WHERE id = ? AND status = \'pending\'',
+      (pending_id,),
+      True
+    )
+
+  async def backlog(self, guild_id:int, limit:int) -> list[sqlite3.Row]:
+    """ Returns the oldest confessions still waiting in vetting for a guild """
+    return await self.run(
+      self._fetch,
+      'SELECT * FROM pending WHERE status = \'pending\' AND guild_id = ? '
+      'AND vetting_message_id IS NOT NULL ORDER BY created LIMIT ?',
+      (guild_id, limit)
+    )
+
+  async def count(self, guild_id:int) -> int:
+    """ Returns the number of confessions waiting in vetting for a guild """
+    row = await self.run(
+      self._fetch,
+      'SELECT COUNT(*) FROM pending WHERE status = \'pending\' AND guild_id = ? '
+      'AND vetting_message_id IS NOT NULL',
+      (guild_id,),
+      True
+    )
+    return row[0]
+
+  async def resolve(self, pending_id:str, status:str):
+    """ Marks a stored confession as approved or denied """
+    await self.run(
+      self._write,
+      'UPDATE pending SET status = ?, resolved = ? WHERE id = ?',
+      (status, time.time(), pending_id)
+    )
+
+  async def remove(self, pending_id:str):
+    """ Deletes a stored confession, for when the vetting message couldn't be sent """
+    await self.run(self._write, 'DELETE FROM pending WHERE id = ?', (pending_id,))
+
+  async def forget_guild(self, guild_id:int):
+    """ Deletes every stored confession for a guild """
+    await self.run(self._write, 'DELETE FROM pending WHERE guild_id = ?', (guild_id,))
+
+  async def prune(self, age:float):
+    """ Deletes approved and denied confessions older than age seconds """
+    await self.run(
+      self._write,
+      'DELETE FROM pending WHERE status != \'pending\' AND resolved < ?',
+      (time.time() - age,)
+    )
+
+  async def stats(self) -> dict[str, dict]:
+    """ Confessions by status, and the backlog of each guild with the age of its oldest entry """
+    return await self.run(self._stats)
+
+  def _stats(self) -> dict[str, dict]:
+    statuses = dict(self.db.execute('SELECT status, COUNT(*) FROM pending GROUP BY status'))
+    now = time.time()
+    backlog = {
+      guild_id: {'pending': count, 'oldest': now - oldest}
+      for guild_id, count, oldest in self.db.execute(
+        'SELECT guild_id, COUNT(*), MIN(created) FROM pending WHERE status = \'pending\' '
+        'GROUP BY guild_id'
+      )
+    }
+    return {'statuses': statuses, 'backlog': backlog}
+
+
+class ImageStore:
+  """
+    On-disk copies of images waiting in vetting, owned by the ConfessionsModeration cog
+
+    Images are downloaded once when a confession is submitted and reused when it is approved. Files
+    are named by the sha256 of their contents, so duplicates are only stored once. Files older than
+    max_age are evicted, then the oldest files until the store fits in max_size.
+  """
+  def __init__(self, path:str, *, max_size:int, max_age:float):
+    self.path = path
+    self.max_size = max_size
+    self.max_age = max_age
+    # Partial writes are kept apart so evict() never sees them
+    self.tmp_path = os.path.join(path, 'tmp')
+    # size is updated from worker threads
+    self.lock = threading.Lock()
+    self.size = 0
+    self.hits = 0
+    self.misses = 0
+
+  def open(self):
+    """ Creates the directory if needed and measures what is already stored """
+    os.makedirs(self.tmp_path, exist_ok=True)
+    for entry in os.scandir(self.tmp_path):
+      # Left behind by an interrupted write
+      if entry.is_file():
+        os.remove(entry.path)
+    with self.lock:
+      self.size = sum(entry.stat().st_size for entry in os.scandir(self.path) if entry.is_file())
+
+  async def put(self, file:discord.File) -> str:
+    """ Stores a copy of an image, returns the key needed to get it back """
+    key = await asyncio.to_thread(self._write, file.fp, file.filename.rpartition('.')[2])
+    file.reset()
+    if self.size > self.max_size:
+      await asyncio.to_thread(self.evict)
+    return key
+
+  def _write(self, fp:io.IOBase, extension:str) -> str:
+    fp.seek(0)
+    digest = hashlib.sha256()
+    with tempfile.NamedTemporaryFile(dir=self.tmp_path, delete=False) as temp:
+      while chunk := fp.read(ConfessionData.IMAGE_CHUNK_SIZE):
+        digest.update(chunk)
+        temp.write(chunk)
+    key = f'{digest.hexdigest()}.{extension}'
+    target = os.path.join(self.path, key)
+    with self.lock:
+      # Only count the size if this write created the file, concurrent puts may share a digest
+      if os.path.exists(target):
+        os.remove(temp.name)
+        os.utime(target)
+      else:
+        os.replace(temp.name, target)
+        self.size += os.path.getsize(target)
+    return key
+
+  def get(self, key:str) -> discord.File | None:
+    """ Returns a stored image, ready to be uploaded """
+    try:
+      fp = open(os.path.join(self.path, os.path.basename(key)), 'rb')
+    except FileNotFoundError:
+      self.misses += 1
+      return None
+    self.hits += 1
+    return discord.File(fp, 'file.' + key.rpartition('.')[2])
+
+  def remove(self, key:str):
+    """ Deletes a stored image """
+    target = os.path.join(self.path, os.path.basename(key))
+    with self.lock:
+      try:
+        size = os.path.getsize(target)
+        os.remove(target)
+        self.size -= size
+      except FileNotFoundError:
+        pass
+
+  def evict(self):
+    """ Deletes images that are too old, then the oldest images until under the size limit """
+    with self.lock:
+      entries = sorted(
+        (entry.stat().st_mtime, entry.stat().st_size, entry.path)
+        for entry in os.scandir(self.path) if entry.is_file()
+      )
+      self.size = sum(size for _, size, _ in entries)
+      cutoff = time.time() - self.max_age
+      for mtime, size, path in entries:
+        if mtime >= cutoff and self.size <= self.max_size:
+          break
+        try:
+          os.remove(path)
+          self.size -= size
+        except FileNotFoundError:
+          pass
+
+  def stats(self) -> dict[str, int]:
+    """ Disk usage and hit counters """
+    return {'size': self.size, 'hits': self.hits, 'misses': self.misses}
+
+
+class DMNotifier:
+  """
+    Sends DM notifications in the background from a fixed pool of workers, owned by the
+    ConfessionsModeration cog
+
+    The dm_notifications opt-out list is kept as a set and only parsed again when the config
+    changes. DM channels are remembered by user so each user only needs create_dm once.
+  """
+  def __init__(
+    self,
+    bot:MerelyBot,
+    config:SectionProxy,
+    *,
+    workers:int,
+    retries:int,
+    size:int,
+    queue_size:int
+  ):
+    """
+      Parameters
+      ----------
+      workers: Number of DMs that can be in flight at once
+      retries: Number of times a rate limited DM is retried before giving up
+      size: Number of DM channels to remember
+      queue_size: Number of DMs that can wait to be sent, more are dropped
+    """
+    self.bot = bot
+    self.config = config
+    self.worker_count = workers
+    self.backoff = RateLimitBackoff(retries)
+    self.queue_size = queue_size
+    self.optout_raw:str | None = None
+    self.optout:set[int] = set()
+    self.dm_channels:BoundedLRU[int, int] = BoundedLRU(size)
+    self.queue:asyncio.Queue[tuple[discord.abc.User, str]] | None = None
+    self.workers:list[asyncio.Task] = []
+    self.sent = 0
+    self.skipped = 0
+    self.blocked = 0
+    self.failed = 0
+    self.dropped = 0
+
+  async def start(self):
+    """ Starts the workers, must be called from within the event loop """
+    if self.workers:
+      return
+    self.queue = asyncio.Queue(maxsize=self.queue_size)
+    self.workers = [asyncio.create_task(self.worker()) for _ in range(self.worker_count)]
+
+  def close(self):
+    """ Stops the workers, anything still queued is dropped """
+    for task in self.workers:
+      task.cancel()
+    self.workers = []
+    self.queue = None
+
+  def opted_out(self, user_id:int) -> bool:
+    """ Checks the dm_notifications opt-out list, parsing it again only if it has changed """
+    raw = self.config.get('dm_notifications', '')
+    if raw != self.optout_raw:
+      self.optout = {int(i) for i in raw.split(',') if i.strip().isdigit()}
+      self.optout_raw = raw
+    return user_id in self.optout
+
+  def notify(self, user:discord.abc.User, content:str) -> bool:
+    """
+      Queue a DM for a user, returns False if they have opted out of DM notifications or the queue
+      is full
+    """
+    if self.opted_out(user.id):
+      self.skipped += 1
+      return False
+    if self.queue is None:
+      raise Exception("DMNotifier was used before it was started or after it was closed")
+    try:
+      self.queue.put_nowait((user, content))
+    except asyncio.QueueFull:
+      self.dropped += 1
+      return False
+    return True
+
+  async def worker(self):
+    """ Sends DMs for as long as the notifier is running """
+    while True:
+      user, content = await self.queue.get()
+      try:
+        await self.send(user, content)
+        self.sent += 1
+      except discord.Forbidden:
+        # DMs are closed, or the user has blocked the bot
+        self.blocked += 1
+      except Exception as e:
+        # Keep the worker alive whatever happens, or the queue would stop draining
+        self.failed += 1
+        print(f" - WARN: Failed to send a DM notification; {e!r}")
+
+  async def get_dm_channel(self, user:discord.abc.User) -> discord.abc.Messageable:
+    """ Returns a DM channel for the user, only calling create_dm if it isn't known yet """
+    if user.dm_channel:
+      return user.dm_channel
+    if (channel_id := self.dm_channels.get(user.id)) is not None:
+      return self.bot.get_partial_messageable(channel_id, type=discord.ChannelType.private)
+    channel = await user.create_dm()
+    self.dm_channels.put(user.id, channel.id)
+    return channel
+
+  async def send(self, user:discord.abc.User, content:str):
+    """ Send a DM, retrying with backoff if Discord responds with 429 Too Many Requests """
+    async def factory():
+      channel = await self.get_dm_channel(user)
+      return await channel.send(content)
+    return await self.backoff.run(factory)
+
+  def stats(self) -> dict[str, int]:
+    """ Queue depth, opt-outs and delivery counters """
+    return {
+      'queued': self.queue.qsize() if self.queue else 0,
+      'dm_channels': len(self.dm_channels),
+      'optout': len(self.optout),
+      'sent': self.sent,
+      'skipped': self.skipped,
+      'blocked': self.blocked,
+      'failed': self.failed,
+      'dropped': self.dropped,
+      'retried': self.backoff.retried
+    }
+
+
+class ReportEntry:
+  """ All reports of one confession, and the post that summarises them in the report channel """
+  def __init__(self, message:discord.Message, server:str):
+    self.message_id = message.id
+    self.server = server
+    if len(message.embeds) > 0:
+      self.embed = message.embeds[0]
+    else:
+      self.embed = discord.Embed(description=f'**{message.author.name}** {message.content}')
+    self.reporters:set[int] = set()
+    self.reasons:list[tuple[str, str]] = []
+    self.post:discord.Message | None = None
+    self.task:asyncio.Task | None = None
+    self.dirty = False
+
+
+class ReportAggregator:
+  """
+    Collects reports of the same confession over a short window and posts one entry for them in
+    the report channel, which is edited as more reports come in, owned by the
+    ConfessionsModeration cog
+
+    The report channel is fetched once and cached. Entries are kept in an LRU so a confession that
+    is reported again later updates its existing post instead of starting a new one.
+  """
+  def __init__(
+    self,
+    bot:MerelyBot,
+    render:Callable[[discord.abc.GuildChannel, ReportEntry], str],
+    *,
+    window:float,
+    size:int
+  ):
+    """
+      Parameters
+      ----------
+      render: Builds the content of a report post from an entry
+      window: Seconds to wait for more reports before posting or editing
+      size: Number of reported confessions to remember
+    """
+    self.bot = bot
+    self.render = render
+    self.window = window
+    self.channel_id:int | None = None
+    self.channel:discord.TextChannel | None = None
+    self.entries:BoundedLRU[int, ReportEntry] = BoundedLRU(size)
+    # Includes entries that have been evicted but not posted yet
+    self.tasks:set[asyncio.Task] = set()
+    self.closing = asyncio.Event()
+    self.reports = 0
+    self.duplicates = 0
+    self.posts = 0
+    self.edits = 0
+    self.failed = 0
+
+  async def get_channel(self, channel_id:int) -> discord.TextChannel:
+    """ Returns the report channel, it's only fetched the first time or if the config changes """
+    self.channel_id = channel_id
+    if self.channel is None or self.channel.id != channel_id:
+      self.channel = self.bot.get_channel(channel_id) or await self.bot.fetch_channel(channel_id)
+    return self.channel
+
+  def add(self, message:discord.Message, server:str, user:str, user_id:int, reason:str) -> bool:
+    """
+      Queue a report of a confession, get_channel must have succeeded beforehand
+
+      Returns False if this user has already reported this confession
+    """
+    entry = self.entries.get(message.id)
+    if entry is None:
+      # Evicted entries that are still waiting to be posted are kept alive by their task
+      entry = ReportEntry(message, server)
+      self.entries.put(message.id, entry)
+    if user_id in entry.reporters:
+      self.duplicates += 1
+      return False
+    entry.reporters.add(user_id)
+    entry.reasons.append((user, reason))
+    entry.dirty = True
+    self.reports += 1
+    if entry.task is None:
+      entry.task = asyncio.create_task(self.flush(entry))
+      self.tasks.add(entry.task)
+      entry.task.add_done_callback(self.tasks.discard)
+    return True
+
+  async def flush(self, entry:ReportEntry):
+    """ Posts or edits the entry once the window has passed, until no new reports arrive """
+    try:
+      while entry.dirty:
+        if not self.closing.is_set():
+          # Wait out the window, unless the cog is unloading
+          with contextlib.suppress(asyncio.TimeoutError):
+            await asyncio.wait_for(self.closing.wait(), self.window)
+        entry.dirty = False
+        for attempt in range(2):
+          channel = self.channel or await self.get_channel(self.channel_id)
+          try:
+            await self.post(channel, entry, self.render(channel, entry))
+            break
+          except (discord.NotFound, discord.Forbidden) as e:
+            # The channel may have been deleted or lost permissions, fetch it again and retry once
+            print(f" - WARN: Lost access to the report channel {self.channel_id}; {e}")
+            self.channel = None
+            entry.post = None
+            if attempt:
+              raise
+    except Exception as e:
+      self.failed += 1
+      print(f" - WARN: Dropped {len(entry.reasons)} reports of message {entry.message_id}; {e!r}")
+    finally:
+      entry.task = None
+
+  async def post(self, channel:discord.TextChannel, entry:ReportEntry, content:str):
+    """ Edit the existing report post, or send a new one """
+    submit = self.submit
+    if entry.post is not None:
+      try:
+        await submit(channel, lambda: entry.post.edit(content=content))
+        self.edits += 1
+        return
+      except discord.NotFound as e:
+        if e.code != 10008:
+          # Not just the post, the channel is gone (10008 is Unknown Message)
+          raise
+        entry.post = None
+    entry.post = await submit(channel, lambda: channel.send(content, embed=entry.embed))
+    self.posts += 1
+
+  def submit(self, channel:discord.TextChannel, factory:Callable[[], Awaitable]) -> Awaitable:
+    """ Send through the dispatcher, or directly if it has already been closed """
+    confessions:Confessions | None = self.bot.cogs.get('Confessions')
+    if confessions and confessions.dispatcher.workers:
+      return confessions.dispatcher.submit(channel, factory)
+    return factory()
+
+  async def close(self, timeout:float = 10):
+    """ Post every report that is still waiting for its window to pass, then forget them all """
+    self.closing.set()
+    if self.tasks:
+      await asyncio.wait(self.tasks, timeout=timeout)
+    for task in self.tasks:
+      task.cancel()
+    self.entries.clear()
+
+  def stats(self) -> dict[str, int]:
+    """ Report counters and the number of reported confessions being remembered """
+    return {
+      'entries': len(self.entries),
+      'reports': self.reports,
+      'duplicates': self.duplicates,
+      'posts': self.posts,
+      'edits': self.edits,
+      'failed': self.failed
+    }
+
+
 class ConfessionsModeration(commands.Cog):
   """ Moderate anonymous messaging on your server """
   SCOPE = 'confessions'
@@ -46,12 +694,62 @@ class ConfessionsModeration(commands.Cog):
 
   def __init__(self, bot:MerelyBot):
     self.bot = bot
-    self.button_lock:list[str] = []
+    self.button_locks = KeyedLocks(timeout=120)
     self.jump_url_pattern = re.compile(r"https://discord\.com/channels/(\d+)/(\d+)/(\d+)")
+    self.anonid_pattern = re.compile(r"[0-9a-f]{6}")
+    self.anonid_split_pattern = re.compile(r"[\s,]+")
 
     if not bot.config.getboolean('extensions', 'confessions', fallback=False):
       raise Exception("Module `confessions` must be enabled!")
 
+    # ensure config file has required data
+    if not bot.config.has_section(self.SCOPE):
+      bot.config.add_section(self.SCOPE)
+    if 'pending_db' not in self.config:
+      self.config['pending_db'] = 'config/pending.db'
+    if 'pending_retention' not in self.config:
+      self.config['pending_retention'] = str(30 * 24 * 60 * 60)
+    if 'image_store' not in self.config:
+      self.config['image_store'] = 'config/images'
+    if 'image_store_size' not in self.config:
+      self.config['image_store_size'] = str(500_000_000)
+    if 'image_store_age' not in self.config:
+      self.config['image_store_age'] = str(7 * 24 * 60 * 60)
+    if 'review_concurrency' not in self.config:
+      self.config['review_concurrency'] = '5'
+    if 'dm_workers' not in self.config:
+      self.config['dm_workers'] = '4'
+    if 'dm_retries' not in self.config:
+      self.config['dm_retries'] = '3'
+    if 'dm_channel_cache' not in self.config:
+      self.config['dm_channel_cache'] = '10000'
+    if 'dm_queue_size' not in self.config:
+      self.config['dm_queue_size'] = '1000'
+    if 'report_window' not in self.config:
+      self.config['report_window'] = '30'
+    if 'report_cache_size' not in self.config:
+      self.config['report_cache_size'] = '1000'
+    self.pending = PendingStore(self.config['pending_db'])
+    self.image_store = ImageStore(
+      self.config['image_store'],
+      max_size=self.config.getint('image_store_size'),
+      max_age=self.config.getfloat('image_store_age')
+    )
+    self.notifier = DMNotifier(
+      bot,
+      self.config,
+      workers=self.config.getint('dm_workers'),
+      retries=self.config.getint('dm_retries'),
+      size=self.config.getint('dm_channel_cache'),
+      queue_size=self.config.getint('dm_queue_size')
+    )
+    self.reports = ReportAggregator(
+      bot,
+      self.render_report,
+      window=self.config.getfloat('report_window'),
+      size=self.config.getint('report_cache_size')
+    )
+
     self.report = app_commands.ContextMenu(
       name="Report confession",
       allowed_contexts=app_commands.AppCommandContext(guild=True, private_channel=False),
@@ -60,8 +758,28 @@ class ConfessionsModeration(commands.Cog):
     )
     bot.tree.add_command(self.report)
 
-  def cog_unload(self):
+  async def cog_load(self):
+    await self.pending.open()
+    await self.pending.prune(self.config.getfloat('pending_retention'))
+    self.image_store.open()
+    await asyncio.to_thread(self.image_store.evict)
+    await self.notifier.start()
+
+  async def cog_unload(self):
     self.bot.tree.remove_command(self.report.name, type=self.report.type)
+    await self.reports.close()
+    self.pending.close()
+    self.notifier.close()
+
+  async def stats(self) -> dict[str, dict]:
+    """ Counters of this cog's caches and queues, collected by Confessions.stats """
+    return {
+      'button_locks': self.button_locks.stats(),
+      'pending': await self.pending.stats(),
+      'image_store': self.image_store.stats(),
+      'notifier': self.notifier.stats(),
+      'reports': self.reports.stats()
+    }
 
   # Context menu commands
 
@@ -105,16 +823,31 @@ class ConfessionsModeration(commands.Cog):
       Checks are performed at this stage
     """
     preface = self.babel(vettingchannel.guild, 'vetmessagecta', channel=data.targetchannel.mention)
-    view = self.PendingConfessionView(self, data)
-    success = await data.send_confession(
-      inter,
-      channel=vettingchannel,
-      webhook_override=False,
-      preface_override=preface,
-      view=view
-    )
+    pending_id = await self.pending.add(data)
+    image_key = None
+    success = False
+    try:
+      if data.file:
+        # Keep a copy so the image doesn't need to be downloaded again on approval
+        image_key = await self.image_store.put(data.file)
+        await self.pending.set_image(pending_id, image_key)
+      view = self.PendingConfessionView(self, data, pending_id)
+      success = await data.send_confession(
+        inter,
+        channel=vettingchannel,
+        webhook_override=False,
+        preface_override=preface,
+        view=view
+      )
+    finally:
+      if not success:
+        # Nothing in the vetting channel refers to these, so don't keep them
+        await self.pending.remove(pending_id)
+        if image_key:
+          await self.release_stored_image(image_key)
 
     if success:
+      await self.pending.set_message(pending_id, data.message)
       await inter.followup.send(
         self.babel(inter, 'confession_vetting', channel=data.targetchannel.mention),
         ephemeral=True
@@ -124,11 +857,13 @@ class ConfessionsModeration(commands.Cog):
 
   class PendingConfessionView(discord.ui.View):
     """ Asks moderators to approve or deny a confession as a part of vetting """
-    def __init__(self, parent:ConfessionsModeration, pendingconfession:"ConfessionData"):
+    def __init__(
+      self, parent:ConfessionsModeration, pendingconfession:"ConfessionData", pending_id:str
+    ):
       super().__init__(timeout=None)
 
       guild = pendingconfession.targetchannel.guild
-      data = pendingconfession.store()
+      data = PendingStore.ID_PREFIX + pending_id
       self.add_item(discord.ui.Button(
         label=parent.babel(guild, 'vetting_approve_button'),
         emoji='✅',
@@ -212,29 +947,21 @@ class ConfessionsModeration(commands.Cog):
       self.origin = origin
 
     async def on_submit(self, inter: discord.Interaction):
-      """ Send report to mod channel as configured """
+      """ Queue the report for the report channel as configured """
       if self.parent.config['report_channel']:
-        reportchannel = await safe_fetch_channel(
-          self.parent, inter, int(self.parent.config.get('report_channel'))
-        )
-        if reportchannel is None:
+        try:
+          await self.parent.reports.get_channel(int(self.parent.config.get('report_channel')))
+        except (discord.Forbidden, discord.NotFound):
           await inter.response.send_message(
             self.parent.babel(inter, 'report_failed')
           )
           return
-        embed:discord.Embed
-        if len(self.message.embeds) > 0:
-          embed = self.message.embeds[0]
-        else:
-          embed = discord.Embed(description=f'**{self.message.author.name}** {self.message.content}')
-        await reportchannel.send(
-          self.parent.babel(
-            reportchannel.guild, 'new_report',
-            server=f'{inter.guild.name} ({inter.guild.id})',
-            user=f'{inter.user.mention} ({inter.user.name}#{inter.user.discriminator})',
-            reason=self.report_reason.value
-          ),
-          embed=embed,
+        self.parent.reports.add(
+          self.message,
+          server=f'{inter.guild.name} ({inter.guild.id})',
+          user=f'{inter.user.mention} ({inter.user.name}#{inter.user.discriminator})',
+          user_id=inter.user.id,
+          reason=self.report_reason.value
         )
         await inter.response.send_message(
           self.parent.babel(inter, 'report_success'),
@@ -242,8 +969,55 @@ class ConfessionsModeration(commands.Cog):
           suppress_embeds=True
         )
 
+  def render_report(self, reportchannel:discord.abc.GuildChannel, entry:ReportEntry) -> str:
+    """ Lists every reason a confession was reported for, within the message length limit """
+    count = len(entry.reporters)
+    report = self.babel(
+      reportchannel.guild, 'new_report',
+      server=entry.server, count=count, multiple=count > 1
+    )
+    for i, (user, reason) in enumerate(entry.reasons):
+      line = '\n> ' + user + ': ' + ' '.join(reason.split())[:300]
+      #BABEL: new_report_more
+      more = '\n' + self.babel(reportchannel.guild, 'new_report_more', count=count - i)
+      if len(report) + len(line) + len(more) > 2000:
+        report += more
+        break
+      report += line
+    return report
+
+  async def load_pending(self, payload:str) -> tuple[ConfessionData, sqlite3.Row | None]:
+    """
+      Restores a confession from the custom_id of a vetting button
+
+      Returns the confession and its PendingStore record, older buttons carry the encrypted data
+      themselves and have no record
+    """
+    pendingconfession = ConfessionData(self)
+    if payload.startswith(PendingStore.ID_PREFIX):
+      pending_id = payload[len(PendingStore.ID_PREFIX):]
+      record = await self.pending.get(pending_id)
+      if record is None:
+        raise CorruptConfessionDataException("Pending confession not found;", pending_id)
+      await pendingconfession.from_binary(
+        self.crypto, record['payload'], record['reference_channel_id']
+      )
+      return pendingconfession, record
+    await pendingconfession.from_binary(self.crypto, payload)
+    return pendingconfession, None
+
+  async def release_stored_image(self, image_key:str):
+    """ Delete a stored image once no confessions in vetting need it """
+    if not await self.pending.image_in_use(image_key):
+      await asyncio.to_thread(self.image_store.remove, image_key)
+
   # Events
 
+  @commands.Cog.listener('on_guild_remove')
+  async def pending_cleanup(self, guild:discord.Guild):
+    """ Forget confessions waiting in the vetting channel of a guild on removal """
+    await self.pending.forget_guild(guild.id)
+
   @commands.Cog.listener('on_interaction')
   async def on_confession_review(self, inter:discord.Interaction):
     """ Handle approving and denying confessions """
@@ -252,137 +1026,256 @@ class ConfessionsModeration(commands.Cog):
     custom_id = inter.data.get('custom_id')
     if not custom_id.startswith('pendingconfession_'):
       return
-    if custom_id in self.button_lock:
+    # Approve and deny share a lock so only one of them can go through
+    lock_key = custom_id.split('_', 2)[-1]
+    if self.button_locks.locked(lock_key):
       await inter.response.send_message(
         "Somebody else has already pressed this button!", ephemeral=True
       )
       return
 
-    await inter.response.defer()
-    self.button_lock.append(custom_id)
+    async with self.button_locks.hold(lock_key):
+      await inter.response.defer()
+      await self.review_confession(inter, custom_id)
+
+  async def review_confession(self, inter:discord.Interaction, custom_id:str):
+    """ Approve or deny a confession, the button must be locked by the caller """
     accepted = False
     try:
       if custom_id.startswith('pendingconfession_approve_'):
         accepted = True
-        pendingconfession = ConfessionData(self)
-        await pendingconfession.from_binary(self.crypto, custom_id[26:])
-        pendingconfession.set_content(embed=inter.message.embeds[0])
-        if pendingconfession.reference is None:
-          # Try and recover reference if it's lost
-          if match := self.jump_url_pattern.search(inter.message.content):
-            _, channel_id, message_id = map(int, match.groups())
-            channel = inter.guild.get_channel(channel_id)
-            reference = channel.get_partial_message(message_id)
-            pendingconfession.create(reference=reference)
+        pendingconfession, record = await self.load_pending(custom_id[26:])
+        await self.prepare_approval(pendingconfession, record, inter.message)
       elif custom_id.startswith('pendingconfession_deny_'):
-        pendingconfession = ConfessionData(self)
-        await pendingconfession.from_binary(self.crypto, custom_id[23:])
+        pendingconfession, record = await self.load_pending(custom_id[23:])
       else:
-        self.button_lock.remove(custom_id)
         raise Exception("Unknown button action", custom_id)
     except CorruptConfessionDataException:
       await inter.followup.send(self.babel(inter, 'vetcorrupt'))
-      self.button_lock.remove(custom_id)
       return
     except (discord.NotFound, discord.Forbidden):
       if accepted:
         await inter.followup.send(self.babel(inter, 'vettingrequiredmissing'))
-      self.button_lock.remove(custom_id)
       return
 
     if accepted:
-      try:
-        if inter.message.embeds[0].image:
-          await pendingconfession.add_image(url=inter.message.embeds[0].image.url)
-        elif (
-          len(inter.message.attachments) and
-          inter.message.attachments[0].content_type.startswith('image')
-        ):
-          await pendingconfession.add_image(attachment=inter.message.attachments[0])
-        if not await pendingconfession.send_confession(inter, perform_checks=False):
-          self.button_lock.remove(custom_id)
-          return
-      except Exception as e:
-        self.button_lock.remove(custom_id)
-        raise e
+      if not await pendingconfession.send_confession(inter, perform_checks=False):
+        # The button can be pressed again, which will load the image again
+        pendingconfession.release_image()
+        return
+
+    await self.conclude_review(pendingconfession, record, inter.message, inter.user, accepted)
+    self.notify_author(pendingconfession, accepted)
+
+  async def prepare_approval(
+    self,
+    pendingconfession:ConfessionData,
+    record:sqlite3.Row | None,
+    message:discord.Message
+  ):
+    """ Restore the content, reply and image of a confession from its vetting message """
+    pendingconfession.set_content(embed=message.embeds[0])
+    if pendingconfession.reference is None:
+      # Try and recover reference if it's lost
+      if match := self.jump_url_pattern.search(message.content):
+        _, channel_id, message_id = map(int, match.groups())
+        channel = message.guild.get_channel(channel_id)
+        reference = channel.get_partial_message(message_id)
+        pendingconfession.create(reference=reference)
 
-    metadata = {'user':inter.user.mention, 'channel':pendingconfession.targetchannel.mention}
+    image_key = record['image_key'] if record else None
+    if image_key and (file := self.image_store.get(image_key)):
+      pendingconfession.attach_file(file)
+    elif message.embeds[0].image:
+      await pendingconfession.add_image(url=message.embeds[0].image.url)
+    elif (
+      len(message.attachments) and
+      message.attachments[0].content_type.startswith('image')
+    ):
+      await pendingconfession.add_image(attachment=message.attachments[0])
+
+  async def conclude_review(
+    self,
+    pendingconfession:ConfessionData,
+    record:sqlite3.Row | None,
+    message:discord.Message,
+    moderator:discord.abc.User,
+    accepted:bool
+  ):
+    """ Replace the vetting buttons with the outcome and mark the confession as handled """
+    metadata = {'user':moderator.mention, 'channel':pendingconfession.targetchannel.mention}
     if accepted:
-      msg = self.babel(inter.guild, 'vetaccepted', **metadata)
+      msg = self.babel(message.guild, 'vetaccepted', **metadata)
     else:
-      msg = self.babel(inter.guild, 'vetdenied', **metadata)
-    try:
-      await inter.message.edit(content=msg, view=None)
-    except Exception as e:
-      self.button_lock.remove(custom_id)
-      raise e
-    self.button_lock.remove(custom_id)
+      msg = self.babel(message.guild, 'vetdenied', **metadata)
+    await message.edit(content=msg, view=None)
+    if record:
+      await self.pending.resolve(record['id'], 'approved' if accepted else 'denied')
+      if record['image_key']:
+        await self.release_stored_image(record['image_key'])
 
+  def notify_author(self, pendingconfession:ConfessionData, accepted:bool):
+    """ Let the author know the outcome in the background, unless they've disabled DMs """
     #BABEL: confession_vetting_accepted,confession_vetting_denied
     content = self.babel(
       pendingconfession.author,
       'confession_vetting_accepted' if accepted else 'confession_vetting_denied',
       channel=f"<#{pendingconfession.targetchannel.id}>"
     )
-    if str(pendingconfession.author.id) not in self.config.get('dm_notifications', '').split(','):
-      try:
-        if not pendingconfession.author.dm_channel:
-          await pendingconfession.author.create_dm()
-        await pendingconfession.author.send(content)
-      except discord.Forbidden:
-        pass
+    self.notifier.notify(pendingconfession.author, content)
+
+  async def bulk_review_one(
+    self,
+    inter:discord.Interaction,
+    record:sqlite3.Row,
+    vettingchannel:discord.TextChannel,
+    accepted:bool,
+    semaphore:asyncio.Semaphore
+  ) -> ConfessionData | None:
+    """ Approve or deny one confession from the backlog, returns it if successful """
+    payload = PendingStore.ID_PREFIX + record['id']
+    if self.button_locks.locked(payload):
+      # Somebody is handling this one already
+      return None
+    try:
+      async with semaphore, self.button_locks.hold(payload):
+        try:
+          message = await vettingchannel.fetch_message(record['vetting_message_id'])
+        except discord.NotFound:
+          # Nobody can review this one anymore, stop listing it
+          await self.pending.resolve(record['id'], 'deleted')
+          if record['image_key']:
+            await self.release_stored_image(record['image_key'])
+          return None
+        pendingconfession, record = await self.load_pending(payload)
+        if accepted:
+          await self.prepare_approval(pendingconfession, record, message)
+          if not await pendingconfession.send_confession(inter, perform_checks=False):
+            pendingconfession.release_image()
+            return None
+        await self.conclude_review(pendingconfession, record, message, inter.user, accepted)
+    except (CorruptConfessionDataException, discord.HTTPException, asyncio.TimeoutError):
+      # Already handled, deleted, or out of reach, the rest of the batch carries on
+      return None
+    except Exception as e:
+      # Don't let one confession stop the batch or the summary, but make sure it's seen
+      print(f" - WARN: Failed to review pending confession {record['id']}; {e!r}")
+      return None
+    return pendingconfession
 
   # Commands
 
   @app_commands.command()
   @app_commands.describe(
-    anonid="The anonymous id found next to any traceable anonymous message",
-    unblock="Set to true if you want to unblock this id instead"
+    anonid="One or more anon-ids found next to traceable anonymous messages, separated by spaces",
+    unblock="Set to true if you want to unblock these ids instead"
   )
   @app_commands.allowed_contexts(guilds=True, private_channels=False)
   @app_commands.default_permissions(moderate_members=True)
   async def block(
     self,
     inter:discord.Interaction,
-    anonid:Optional[app_commands.Range[str, 6, 6]] = None,
+    anonid:Optional[app_commands.Range[str, 6, 2000]] = None,
     unblock:Optional[bool] = False
   ):
     """
       Block or unblock anon-ids from confessing
     """
-    banlist_raw = self.config.get(f'{inter.guild.id}_banned', fallback='')
-    banlist = banlist_raw.split(',')
+    banned = ban_index.get(self.config, inter.guild.id)
     if anonid is None:
-      if not banlist_raw:
+      if not banned:
         await inter.response.send_message(self.babel(inter, 'emptybanlist'))
         return
-      printedlist = '\n```\n' + ('\n'.join(banlist)) + '```'
+      printedlist = '\n```\n' + ('\n'.join(sorted(banned))) + '```'
       await inter.response.send_message(self.babel(inter, 'banlist') + printedlist)
       return
 
-    anonid = anonid.lower()
-    try:
-      int(anonid, 16)
-    except ValueError:
+    anonids = {i for i in self.anonid_split_pattern.split(anonid.lower()) if i}
+    if not all(self.anonid_pattern.fullmatch(i) for i in anonids):
       await inter.response.send_message(self.babel(inter, 'invalidanonid'))
       return
-    if anonid in banlist and not unblock:
-      await inter.response.send_message(self.babel(inter, 'doublebananonid'))
-      return
-    #BABEL: nomatchanonid
-    #TODO: keeping this string around in case a new way to check is found
-    # will probably involve storing / retreiving recent anon-ids
 
     if unblock:
-      fullid = [i for i in banlist if anonid in i][0]
-      self.config[str(inter.guild.id)+'_banned'] = banlist_raw.replace(fullid+',','')
+      anonids &= banned
+      if not anonids:
+        await inter.response.send_message(self.babel(inter, 'nomatchanonid'))
+        return
+      ban_index.update(self.config, inter.guild.id, remove=anonids)
     else:
-      self.config[str(inter.guild.id)+'_banned'] = banlist_raw + anonid + ','
+      anonids -= banned
+      if not anonids:
+        await inter.response.send_message(self.babel(inter, 'doublebananonid'))
+        return
+      ban_index.update(self.config, inter.guild.id, add=anonids)
     self.bot.config.save()
 
     #BABEL: unbansuccess,bansuccess
     await inter.response.send_message(
-      self.babel(inter, ('un' if unblock else '')+'bansuccess', user=anonid)
+      self.babel(inter, ('un' if unblock else '')+'bansuccess', user=' '.join(sorted(anonids)))
+    )
+
+  @app_commands.command()
+  @app_commands.describe(
+    action="Approve or deny the oldest messages waiting in vetting, leave blank to list them",
+    limit="The number of messages to list or review, oldest first"
+  )
+  @app_commands.allowed_contexts(guilds=True, private_channels=False)
+  @app_commands.default_permissions(moderate_members=True)
+  async def review(
+    self,
+    inter:discord.Interaction,
+    action:Optional[Literal['approve', 'deny']] = None,
+    limit:app_commands.Range[int, 1, 100] = 25
+  ):
+    """
+      List, approve or deny anonymous messages waiting in vetting
+    """
+    vettingchannel_id = findvettingchannel(self.config, inter.guild.id)
+    records = await self.pending.backlog(inter.guild.id, limit)
+    if vettingchannel_id is None or not records:
+      await inter.response.send_message(self.babel(inter, 'review_empty'), ephemeral=True)
+      return
+
+    if action is None:
+      total = await self.pending.count(inter.guild.id)
+      content = self.babel(inter, 'review_list', count=total)
+      for i, record in enumerate(records):
+        line = (
+          f"\n- https://discord.com/channels/{inter.guild.id}/{vettingchannel_id}/"
+          f"{record['vetting_message_id']} "
+          f"({discord.utils.format_dt(datetime.fromtimestamp(record['created']), 'R')})"
+        )
+        #BABEL: review_list_more
+        more = '\n' + self.babel(inter, 'review_list_more', count=total - i)
+        if len(content) + len(line) + len(more) > 2000:
+          content += more
+          break
+        content += line
+      await inter.response.send_message(content, ephemeral=True, suppress_embeds=True)
+      return
+
+    vettingchannel = inter.guild.get_channel(vettingchannel_id)
+    if vettingchannel is None:
+      await inter.response.send_message(self.babel(inter, 'review_empty'), ephemeral=True)
+      return
+    await inter.response.defer(ephemeral=True)
+    accepted = action == 'approve'
+    semaphore = asyncio.Semaphore(self.config.getint('review_concurrency'))
+    results = await asyncio.gather(*(
+      self.bulk_review_one(inter, record, vettingchannel, accepted, semaphore)
+      for record in records
+    ), return_exceptions=True)
+    reviewed = [r for r in results if isinstance(r, ConfessionData)]
+    for pendingconfession in reviewed:
+      self.notify_author(pendingconfession, accepted)
+
+    #BABEL: review_done
+    await inter.followup.send(
+      self.babel(
+        inter, 'review_done', accepted=accepted, count=len(reviewed),
+        skipped=len(records) - len(reviewed)
+      ),
+      ephemeral=True
     )
 
 
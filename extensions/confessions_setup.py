@@ -19,8 +19,8 @@ if TYPE_CHECKING:
 
 from extensions.controlpanel import Toggleable, Stringable, Listable
 from overlay.extensions.confessions_common import \
-  ChannelType, ChannelSelectView, get_channeltypes, findvettingchannel, get_guildchannels,\
-  set_guildchannels
+  ChannelType, ChannelSelectView, ConfessionTarget, get_channeltypes, findvettingchannel,\
+  get_guildchannels, update_guildchannels, forget_guild, target_sort_key, anonid_cache, ban_index
 
 
 class ConfessionsSetup(commands.Cog):
@@ -61,7 +61,9 @@ class ConfessionsSetup(commands.Cog):
       out += [
         Toggleable(self.SCOPE, f'{inter.guild_id}_imagesupport', 'image_support', default=True),
         Toggleable(self.SCOPE, f'{inter.guild_id}_webhook', 'enable_webhooks', default=False),
-        Stringable(self.SCOPE, f'{inter.guild_id}_preface', 'confession_preface')
+        Stringable(self.SCOPE, f'{inter.guild_id}_preface', 'confession_preface'),
+        Stringable(self.SCOPE, f'{inter.guild_id}_flood_guild', 'flood_guild'),
+        Stringable(self.SCOPE, f'{inter.guild_id}_flood_channel', 'flood_channel')
         #TODO: Add custom pfp stringable, Anon-ID usernames, Anon-Colour pfps
       ]
     return out
@@ -119,16 +121,18 @@ class ConfessionsSetup(commands.Cog):
 
     def regenerate_matches(
       self, parent:ConfessionsSetup, guild:discord.Guild
-    ) -> tuple[discord.TextChannel, ChannelType]:
+    ) -> list[ConfessionTarget]:
       """ Create a list of all channels on the server sorted by categories and position """
       if len(guild.channels) == 0:
         return []
       botmember = guild.get_member(parent.bot.user.id)
       guildchannels = get_guildchannels(parent.config, guild.id)
-      out = [(c, guildchannels.get(c.id, ChannelType.unset)) for c in guild.channels if (
-        isinstance(c, discord.TextChannel) and c.permissions_for(botmember).read_messages
-      )]
-      out.sort(key=lambda t: (t[0].category.position if t[0].category else 0, t[0].position))
+      out = [
+        ConfessionTarget.create(c, guildchannels.get(c.id, ChannelType.unset))
+        for c in guild.channels
+        if isinstance(c, discord.TextChannel) and c.permissions_for(botmember).read_messages
+      ]
+      out.sort(key=target_sort_key)
       return out
 
     async def controlpanel_shortcut(self, inter:discord.Interaction):
@@ -154,21 +158,19 @@ class ConfessionsSetup(commands.Cog):
         if old_mode == ChannelType.unset:
           await inter.response.send_message(self.parent.babel(inter, 'unsetfailure'), ephemeral=True)
           return False
-        guildchannels.pop(channel.id)
       elif mode == ChannelType.vetting:
         if 'ConfessionsModeration' not in self.parent.bot.cogs:
           await inter.response.send_message(self.parent.babel(inter, 'no_moderation'), ephemeral=True)
           return False
-        if findvettingchannel(guildchannels):
+        if findvettingchannel(self.parent.config, channel.guild.id):
           await inter.response.send_message(self.parent.babel(inter, 'singlechannel'), ephemeral=True)
           return False
       if old_mode == mode:
         await inter.response.send_message(self.parent.babel(inter, 'no_change'), ephemeral=True)
         return False
-      if mode != ChannelType.unset:
-        guildchannels[channel.id] = mode
-      set_guildchannels(self.parent.config, channel.guild.id, guildchannels)
+      update_guildchannels(self.parent.config, channel.guild.id, {channel.id: mode})
       self.parent.bot.config.save()
+      self.parent.bot.dispatch('confessions_channels_update', channel.guild)
 
       #BABEL: setsuccess#,unsetsuccess#
       modestring = (
@@ -296,7 +298,8 @@ class ConfessionsSetup(commands.Cog):
     @discord.ui.button(style=discord.ButtonStyle.green, emoji='➡️', custom_id='shufflebanreset_yes')
     async def continue_button(self, inter:discord.Interaction, _:discord.Button):
       """ On click of continue button """
-      self.parent.config.pop(str(inter.guild.id)+'_banned')
+      self.parent.config.pop(str(inter.guild.id)+'_banned', None)
+      ban_index.forget(inter.guild.id)
       self.parent.perform_shuffle(inter.guild_id)
       await inter.response.send_message(self.parent.babel(inter, 'shufflesuccess'))
       await self.origin.delete_original_response()
@@ -324,18 +327,20 @@ class ConfessionsSetup(commands.Cog):
         # Remove config for any guilds the bot can't access
         if guild is None:
           self.config.pop(key)
+          forget_guild(int(guild_id))
           if not self.bot.quiet and guild_id not in removed:
             print("Removed guild", guild_id, "from config.")
           removed.append(guild_id)
         # Remove config for any channels the bot can't access
         elif key.endswith('_channels'):
           guildchannels = get_guildchannels(self.config, guild.id)
-          for channel_id in list(guildchannels):
-            if guild.get_channel(channel_id) is None:
-              guildchannels.pop(channel_id)
-              if not self.bot.quiet:
+          lost = {c:ChannelType.unset for c in guildchannels if guild.get_channel(c) is None}
+          if lost:
+            update_guildchannels(self.config, guild.id, lost)
+            self.bot.dispatch('confessions_channels_update', guild)
+            if not self.bot.quiet:
+              for channel_id in lost:
                 print("Removed channel", channel_id, "from guild", guild_id, "config.")
-          set_guildchannels(self.config, guild.id, guildchannels)
 
     self.bot.config.save()
     if self.bot.verbose:
@@ -348,6 +353,7 @@ class ConfessionsSetup(commands.Cog):
     for key in list(k for k in self.config if k.startswith(str(guild.id)+'_')):
       self.config.pop(key)
       removed = True
+    forget_guild(guild.id)
     self.bot.config.save()
     if removed and not self.bot.quiet:
       print("Removed guild", guild.id, "from config.")
@@ -355,12 +361,11 @@ class ConfessionsSetup(commands.Cog):
   @commands.Cog.listener('on_guild_channel_delete')
   async def channel_cleanup(self, channel:discord.TextChannel):
     """ Automatically remove data related to a channel on delete """
-    guildchannels = get_guildchannels(self.config, channel.guild.id)
-    if channel.id in guildchannels:
-      guildchannels.pop(channel.id)
+    if channel.id in get_guildchannels(self.config, channel.guild.id):
+      update_guildchannels(self.config, channel.guild.id, {channel.id: ChannelType.unset})
+      self.bot.dispatch('confessions_channels_update', channel.guild)
       if not self.bot.quiet:
         print("Removed channel", channel.id, "from guild", channel.guild.id, "config.")
-      set_guildchannels(self.config, channel.guild.id, guildchannels)
     self.bot.config.save()
 
   # Commands
@@ -399,6 +404,7 @@ class ConfessionsSetup(commands.Cog):
   def perform_shuffle(self, guild_id:int):
     salt = self.bot.cogs['Confessions'].crypto.srandom_token()
     self.bot.config.set(self.SCOPE, str(guild_id) + '_shuffle', b64encode(salt).decode('ascii'))
+    anonid_cache.invalidate(guild_id)
     self.bot.config.save()
 
 